@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import argparse
+from typing import List, Tuple
+
+import numpy as np
+import pygame as pg
+
+from core.game import Game, PROFILER_STAGES
+from utils.beatmap_utils import HOLD, get_map_duration
+from utils.game_clock import GameClock
+from utils.profiler import FrameProfiler
+
+# Через сколько мс после нажатия автоплей отпускает клавишу ноты
+NOTE_RELEASE_DELAY = 40
+
+
+class SimulatedClock(GameClock):
+    """
+    Часы карты, которые идут не сами, а только по advance: бенчмарк прогоняет карту
+    так быстро, как может, и результат не зависит от скорости машины.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.elapsed = 0.
+
+    def start(self, lead_in: float = None) -> None:
+        super().start(lead_in)
+        self.elapsed = 0.
+
+    def get_raw_time(self) -> float:
+        return self.elapsed - self.lead_in
+
+    def advance(self, interval: float) -> None:
+        """
+        Переводит часы вперёд
+
+        :param interval: на сколько мс
+        :return: None
+        """
+        self.elapsed += interval
+
+
+def get_autoplay_events(columns: List[np.ndarray]) -> List[Tuple[float, int, int]]:
+    """
+    Строит нажатия и отпускания клавиш, которые точно попадают в каждый объект карты
+
+    :param columns: объекты по дорожкам (см. split_columns)
+    :return: список событий (время карты в мс, номер дорожки, состояние клавиши) в хронологическом порядке,
+    при равном времени отпускания идут раньше нажатий
+    """
+    times, tracks, states = [], [], []
+
+    for track_number, column in enumerate(columns):
+        presses = column['time'].astype(np.float64)
+        releases = np.where(column['type'] == HOLD, column['endTime'], presses + NOTE_RELEASE_DELAY)
+        # Клавишу нужно отпустить до следующей ноты дорожки
+        releases[:-1] = np.maximum(np.minimum(releases[:-1], presses[1:] - 1), presses[:-1])
+
+        times += [presses, releases]
+        tracks += [np.full(len(column), track_number)] * 2
+        states += [np.ones(len(column), dtype=int), np.zeros(len(column), dtype=int)]
+
+    if not times:
+        return []
+
+    times, tracks, states = np.concatenate(times), np.concatenate(tracks), np.concatenate(states)
+    order = np.lexsort((states, times))
+
+    return list(zip(times[order].tolist(), tracks[order].tolist(), states[order].tolist()))
+
+
+def run_benchmark(beatmap_file: str, fps: float, size: Tuple[int, int]) -> dict:
+    """
+    Проигрывает карту автоплеем без окна и звука: весь цикл игры (оценка, отрисовка дорожек и текста,
+    обновление дисплея) на симулированных часах с шагом 1000 / fps мс
+
+    :param beatmap_file: путь к файлу карты (может вести внутрь архива .osz)
+    :param fps: частота кадров симулированной игры
+    :param size: размер экрана
+    :return: словарик с результатами (см. main)
+    """
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    pg.init()
+    screen = pg.display.set_mode(size)
+
+    game = Game(screen, os.path.dirname(beatmap_file), os.path.basename(beatmap_file))
+    game.clock = SimulatedClock()
+    game.clock.start(game.get_lead_in())
+    game.reset_screen()
+
+    events = get_autoplay_events(game.columns)
+    next_event = 0
+    frame_interval = 1000 / fps
+    end_time = get_map_duration(game.hitobjects) + 3000
+
+    # Буфер профайлера на все кадры карты, чтобы этапы считались за всю карту
+    game.profiler = FrameProfiler(PROFILER_STAGES, int((end_time + game.get_lead_in()) / frame_interval) + 1)
+
+    frame_times = []
+    start = time.perf_counter()
+
+    while game.get_map_time() < end_time:
+        frame_start = time.perf_counter()
+        game.profiler.start()
+        map_time = game.get_map_time()
+
+        while next_event < len(events) and events[next_event][0] <= map_time:
+            event_time, track_number, key_state = events[next_event]
+            game.set_track_state(track_number, key_state, event_time)
+            next_event += 1
+        game.profiler.lap('events')
+
+        game.judge(map_time)
+        game.profiler.lap('judge')
+        game.draw_frame(map_time)
+        game.profiler.end_frame()
+
+        frame_times.append(time.perf_counter() - frame_start)
+        game.clock.advance(frame_interval)
+
+    total_time = time.perf_counter() - start
+    frame_times = np.array(frame_times) * 1000
+    score_master = game.score_master
+
+    return {
+        'beatmap': beatmap_file,
+        'frames': len(frame_times),
+        'fps': len(frame_times) / total_time,
+        'frame_ms': {name: float(np.percentile(frame_times, q)) for name, q in
+                     (('p50', 50), ('p95', 95), ('p99', 99), ('max', 100))},
+        'stages_ms': {stage: {'mean': mean, 'p99': p99} for stage, (mean, p99) in game.profiler.get_stats().items()
+                      if stage in ('events', 'judge', 'tracks', 'hud', 'display')},
+        'score': score_master.get_score(),
+        'accuracy': score_master.get_accuracy(),
+        'hit_counts': score_master.get_hit_counts(),
+        'max_combo': score_master.get_max_combo(),
+    }
+
+
+def main() -> None:
+    with open('./settings/game_config.json', 'r') as f:
+        game_config = json.load(f)
+
+    parser = argparse.ArgumentParser(description='Play a beatmap with autoplay in a headless window '
+                                                 'as fast as possible and report gameplay throughput.')
+    parser.add_argument('beatmap', help='.osu file (may be inside an .osz archive)')
+    parser.add_argument('--fps', type=float, default=game_config['FPS'],
+                        help='simulated frame rate, sets the map time step (default: %(default)s)')
+    parser.add_argument('--size', type=int, nargs=2, default=(game_config['width'], game_config['height']),
+                        metavar=('WIDTH', 'HEIGHT'), help='screen size (default: %(default)s)')
+    parser.add_argument('--json', help='also write results to this file')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.beatmap, args.fps, tuple(args.size))
+
+    frame_ms = results['frame_ms']
+    print(f"{results['frames']} frames, {results['fps']:.0f} frames/s")
+    print(f"frame time ms: p50 {frame_ms['p50']:.3f}  p95 {frame_ms['p95']:.3f}  "
+          f"p99 {frame_ms['p99']:.3f}  max {frame_ms['max']:.3f}")
+    print('stage ms (mean / p99): ' + '  '.join(f"{stage} {times['mean']:.3f} / {times['p99']:.3f}"
+                                                for stage, times in results['stages_ms'].items()))
+    print(f"score {results['score']}  accuracy {results['accuracy']:.2f}%  "
+          f"hits {results['hit_counts']}  max combo {results['max_combo']}x")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=4)
+
+
+if __name__ == '__main__':
+    main()
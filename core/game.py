@@ -1,55 +1,34 @@
 import time
 import json
 import os
-from typing import Tuple, Callable, Sequence
+import math
+import logging
+from functools import partial
+from typing import Tuple, Callable, Sequence, List
 
 import pygame as pg
 import audioplayer
-import numpy as np
-
-from utils.beatmap_utils import (
-    get_metadata,
-    get_hitobjects,
-    get_map_duration
-)
-from utils.track import Track
+
+from utils.beatmap_utils import HOLD, get_map_duration, get_scroll_position, split_columns
+from utils.beatmap_cache import get_cache
+from utils.archive import open_resource, get_local_path
+from utils.track import Track, get_hit_windows
+from utils.hit_errors import HitErrors
+from utils.game_clock import GameClock, get_playback_position
+from utils.hud import GlyphCache, HudText, HitErrorBar
+from utils.profiler import FrameProfiler
+from utils.frame_pacer import FramePacer, GAME_PACING_MODES
+from utils.replay import ReplayRecorder, REPLAY_EXTENSION, get_event_time
 from utils.ui_objects import stats
 from utils.score_master import ScoreMaster
 from settings.settings import settings
 
+logger = logging.getLogger(__name__)
 
-def get_objects_to_render(map_time: int, hitobjects: np.array, hitobject_count: int,
-                          fall_time: int, render_start: int) -> Tuple[int, int]:
-    """
-    Возвращает какие ноты видны на экране, чтобы рендерить только их
-
-    :param map_time: Время карты в мс
-    :param hitobjects: np.array объектов
-    :param hitobject_count: Количество объектов в списке hitobjeccts.
-    :param render_start: Предыдущее значение начала рендера
-    :param fall_time: Время падения ноты от края до края
-
-    :return: render_start, render_end - индексы, показывающие какие элементы рендерить
-    """
-    new_render_start = render_start
-
-    while True:
-        if hitobjects[new_render_start]['type'] == 'note':
-            obj_time = hitobjects[new_render_start]['time']
-        else:
-            obj_time = hitobjects[new_render_start]['endTime']
-        if obj_time >= map_time - 1000 or new_render_start == hitobject_count - 1:
-            break
-        new_render_start += 1
-
-    i = new_render_start
-    while True:
-        if hitobjects[i]['time'] >= map_time + 1000 + fall_time or i == hitobject_count - 1:
-            break
-        i += 1
-    render_end = i + 1
-
-    return new_render_start, render_end
+# Этапы игрового цикла, время которых замеряется (см. FrameProfiler)
+PROFILER_STAGES = ('events', 'judge', 'audio', 'tracks', 'hud', 'display', 'sleep')
+# Раз в сколько кадров обновляются цифры оверлея профайлера
+PROFILER_OVERLAY_INTERVAL = 30
 
 
 class Game:
@@ -59,7 +38,7 @@ class Game:
     def __init__(self, surface: pg.Surface, beatmap_folder: str, beatmap: str, volume: int = 50):
         """
         :param surface: Поверхность игры
-        :param beatmap_folder: путь директории карты
+        :param beatmap_folder: путь директории карты или архива .osz
         :param beatmap: имя карты (путь относительно beatmap)
         :param volume: громкость
         """
@@ -69,38 +48,43 @@ class Game:
         self.beatmap = os.path.join(beatmap_folder, beatmap)
         self.volume = volume
 
-        self.metadata = get_metadata(self.beatmap)
-        self.hitobjects = get_hitobjects(self.beatmap)
-        self.hitobject_count = len(self.hitobjects)
-
-        self.width, self.height = surface.get_size()
-
         with open('./settings/game_config.json', 'r') as f:
             self.game_config = json.load(f)
 
+        self.metadata, arrays = get_cache(self.game_config).load(self.beatmap)
+        self.hitobjects = arrays['hitobjects']
+        self.scroll_table = (arrays['scroll_times'], arrays['scroll_positions'], arrays['scroll_velocities'])
+
+        self.width, self.height = surface.get_size()
+
         self.settings = settings
 
         self.score = 0
         self.score_master = ScoreMaster()
+        # Смещения нажатий: по одному на ноту и по два на холд (начало и конец)
+        self.hit_errors = HitErrors(len(self.hitobjects) + int((self.hitobjects['type'] == HOLD).sum()))
+        self.hit_windows = get_hit_windows(float(self.metadata['OverallDifficulty']))
 
         self.tracks: list[Track] = []
         self.track_count = int(self.metadata['CircleSize'])
+        self.columns = split_columns(self.hitobjects, self.track_count)
         self.fall_time = 1000
 
         self.exit = False
 
         for i in range(self.track_count):
             self.tracks += [Track(i, self.settings[f'{self.track_count}k_keys'][i], self.score_master,
-                                  od=float(self.metadata['OverallDifficulty']),
+                                  self.columns[i], od=float(self.metadata['OverallDifficulty']),
                                   hit_distance=self.game_config['hit_distance'],
                                   width=self.game_config['track_width'], height=self.height,
                                   note_height=self.game_config['note_height'],
                                   hold_width=self.game_config['hold_width'],
                                   bg_color=self.game_config['track_color'], note_color=self.game_config['note_color'],
                                   hold_color=self.game_config['hold_color'], fall_time=self.fall_time,
-                                  key_color=self.game_config['key_color'])]
+                                  key_color=self.game_config['key_color'], hit_errors=self.hit_errors)]
 
-        self.bg_image = pg.image.load(os.path.join(beatmap_folder, self.metadata['Background']))
+        with open_resource(os.path.join(beatmap_folder, self.metadata['Background'])) as f:
+            self.bg_image = pg.image.load(f, self.metadata['Background'])
         bg_width, bg_height = self.bg_image.get_size()
 
         if bg_height * self.width >= bg_width * self.height:
@@ -108,49 +92,168 @@ class Game:
         else:
             self.bg_image = pg.transform.smoothscale(self.bg_image, (bg_width * self.height // bg_height, self.height))
 
-        self.combo_font = pg.font.Font(os.path.join(self.game_config['assets_directory'], 'PTMono-Regular.ttf'), 70)
-        self.accuracy_font = pg.font.Font(os.path.join(self.game_config['assets_directory'], 'PTMono-Regular.ttf'), 30)
+        font_path = os.path.join(self.game_config['assets_directory'], 'PTMono-Regular.ttf')
+        combo_glyphs = GlyphCache(pg.font.Font(font_path, 70), (255, 255, 255))
+        accuracy_glyphs = GlyphCache(pg.font.Font(font_path, 30), (255, 255, 255))
+        offset_glyphs = GlyphCache(pg.font.Font(font_path, 20), (255, 255, 255))
+
+        self.score_text = HudText(combo_glyphs, (self.width - 20, 20), 'topright')
+        self.accuracy_text = HudText(accuracy_glyphs, (self.width - 20, 40 + combo_glyphs.height), 'topright')
+        # Расхождение часов игры со звуком (см. GameClock)
+        self.offset_text = HudText(offset_glyphs, (20, 20), 'topleft')
+        self.combo_text = HudText(combo_glyphs, (20, self.height - 20), 'bottomleft')
+        # Отклонения последних нажатий и unstable rate над ними
+        self.hit_error_bar = HitErrorBar(self.hit_windows, (self.width - 140, self.height - 20))
+        self.unstable_rate_text = HudText(offset_glyphs, (self.width - 20, self.hit_error_bar.rect.top - 10),
+                                          'bottomright')
+
+        # Замер времени этапов игрового цикла и оверлей с ним (F3)
+        self.profiler = FrameProfiler(PROFILER_STAGES)
+        self.show_profiler = False
+        self.profiler_frame = 0
+        self.profiler_lines = ['' for _ in range(len(PROFILER_STAGES) + 3)]
+        self.profiler_texts = [HudText(offset_glyphs, (20, 30 + offset_glyphs.height * (i + 1)), 'topleft')
+                               for i in range(len(self.profiler_lines))]
+
+        # Нажатия и отпускания клавиш за игру (примерно по два события на объект карты)
+        self.replay = ReplayRecorder(2 * len(self.hitobjects))
+        # До какого времени (целые мс) отмечены пропуски (см. judge)
+        self.judged_time = -math.inf
+
+        self.clock = GameClock()
+        self.full_redraw = False
+        # Обработчик событий игры (см. start), None - события не забираются (например, в бенчмарке)
+        self.handler = None
+
+        # Ритм кадров во время игры и на экране результатов (см. FramePacer)
+        game_pacing = self.game_config.get('game_pacing', 'sleep')
+        if game_pacing not in GAME_PACING_MODES:
+            raise ValueError(f'Unknown game_pacing: {game_pacing}, expected one of {GAME_PACING_MODES}')
+        self.pacer = FramePacer(game_pacing, self.game_config['FPS'])
+        self.menu_pacer = FramePacer(self.game_config.get('menu_pacing', 'event'), self.game_config.get('menu_FPS', 60))
 
         self.finished = False
         self.finished_early = False
         self.finished_score_screen = False
 
-    def __render(self) -> None:
+    def __render(self) -> List[pg.Rect]:
         """
         Рендерит игру на self.surface.
+        Дорожки рисуются каждый кадр целиком, поэтому тексты и полоса отклонений, заходящие на них,
+        после дорожек рисуются поверх них заново (см. HudText.draw_over).
 
-        :return: None
+        :return: Список изменённых областей экрана (дорожки и тексты), только их нужно обновить на дисплее
         """
         x_offset = (self.width -
                     self.track_count * (self.game_config['track_width'] + self.game_config['track_spacing']) +
                     self.game_config['track_spacing']) / 2
-
+        dirty_rects = []
+
+        for hud_text, text in ((self.score_text, f'{self.score_master.get_score()}'),
+                               (self.accuracy_text, f'{self.score_master.get_accuracy():.2f}%'),
+                               (self.offset_text, f'audio {self.clock.offset:+.0f} ms' if self.clock.synced
+                                else 'audio -- ms'),
+                               (self.combo_text, f'{self.score_master.get_combo()}x'),
+                               (self.unstable_rate_text, f'UR {self.hit_errors.get_unstable_rate():.0f}  '
+                                                         f'{self.hit_errors.get_mean():+.1f} ms')):
+            # Текст перерисовывается, только если изменился (см. HudText)
+            dirty_rect = hud_text.draw(self.surface, self.bg_image, text)
+            if dirty_rect is not None:
+                dirty_rects.append(dirty_rect)
+
+        dirty_rect = self.hit_error_bar.draw(self.surface, self.bg_image, self.hit_errors)
+        if dirty_rect is not None:
+            dirty_rects.append(dirty_rect)
+
+        # Оверлей профайлера обновляется раз в PROFILER_OVERLAY_INTERVAL кадров, чтобы цифры можно было прочитать
+        if self.profiler_frame % PROFILER_OVERLAY_INTERVAL == 0:
+            self.update_profiler_lines()
+        self.profiler_frame += 1
+
+        for hud_text, text in zip(self.profiler_texts, self.profiler_lines):
+            dirty_rect = hud_text.draw(self.surface, self.bg_image, text)
+            if dirty_rect is not None:
+                dirty_rects.append(dirty_rect)
+        self.profiler.lap('hud')
+
+        track_rects = []
         for i in range(self.track_count):
             x = (self.game_config['track_width'] + self.game_config['track_spacing']) * i + x_offset
-            self.tracks[i].render(self.surface, x, 0)
+            track_rects.append(self.tracks[i].render(self.surface, x, 0))
+        dirty_rects += track_rects
+        self.profiler.lap('tracks')
 
-        score_surface = self.combo_font.render(f'{self.score_master.get_score()}', True, (255, 255, 255))
-        w, h = score_surface.get_size()
-        self.surface.blit(self.bg_image, (self.width - w - 20, 20), (self.width - w - 20, 20, w, h))
-        self.surface.blit(score_surface, (self.width - w - 20, 20))
+        for hud_element in (self.score_text, self.accuracy_text, self.offset_text, self.combo_text,
+                            self.unstable_rate_text, self.hit_error_bar, *self.profiler_texts):
+            hud_element.draw_over(self.surface, track_rects)
+        self.profiler.lap('hud')
 
-        accuracy_surface = self.accuracy_font.render(f'{self.score_master.get_accuracy():.2f}%', True, (255, 255, 255))
-        w1, h1 = self.accuracy_font.size('100.00%')
-        w2, h2 = accuracy_surface.get_size()
-        self.surface.blit(self.bg_image, (self.width - w1 - 20, 40 + h), (self.width - w1 - 20, 40 + h, w1, h1))
-        self.surface.blit(accuracy_surface, (self.width - w2 - 20, 40 + h))
+        return dirty_rects
 
-        combo_surface = self.combo_font.render(f'{self.score_master.get_combo()}x', True, (255, 255, 255))
-        w, h = self.combo_font.size(f'{self.score_master.get_max_combo()}x')
-        self.surface.blit(self.bg_image, (20, self.height - h - 20),
-                          (20, self.height - h - 20, w, h))
-        self.surface.blit(combo_surface, (20, self.height - h - 20))
+    def update_profiler_lines(self) -> None:
+        """
+        Обновляет строки оверлея профайлера: среднее время и p99 каждого этапа за последние кадры
+
+        :return: None
+        """
+        if not self.show_profiler:
+            self.profiler_lines = ['' for _ in self.profiler_lines]
+            return
 
-    def __end_early(self, key_state: int) -> None:
+        stats = self.profiler.get_stats()
+        self.profiler_lines = [f'{"stage":<8}{"ms":>7}{"p99":>7}'] + \
+                              [f'{stage:<8}{mean:7.2f}{p99:7.2f}' for stage, (mean, p99) in stats.items()] + \
+                              [self.pacer.get_report()]
+
+    def __toggle_profiler(self, key_state: int, map_time: float) -> None:
+        """
+        Показывает или прячет оверлей профайлера
+
+        :param key_state: Состяние клавишы
+        :param map_time: Время нажатия по времени карты в мс
+
+        :return: None
+        """
+        if key_state == 1:
+            self.show_profiler = not self.show_profiler
+            self.update_profiler_lines()
+
+    def save_profile(self) -> None:
+        """
+        Сохраняет гистограммы времени кадра за карту в profile_directory (если он задан в game_config.json)
+
+        :return: None
+        """
+        directory = self.game_config.get('profile_directory')
+        if not directory or not self.profiler.count:
+            return
+
+        name = f"{os.path.splitext(os.path.basename(self.beatmap))[0]} {time.strftime('%Y-%m-%d %H-%M-%S')}.json"
+        self.profiler.export(os.path.join(directory, name),
+                             {'beatmap': self.beatmap, 'FPS': self.game_config['FPS'],
+                              'input_rate': self.game_config.get('input_rate'), 'size': [self.width, self.height],
+                              'pacing': self.pacer.mode, 'pacing_jitter': self.pacer.get_jitter(),
+                              'audio_offset': self.clock.offset if self.clock.synced else None})
+
+    def save_replay(self) -> None:
+        """
+        Сохраняет нажатия клавиш за игру в replay_directory (если он задан в game_config.json)
+
+        :return: None
+        """
+        directory = self.game_config.get('replay_directory')
+        if not directory or not self.replay.count:
+            return
+
+        name = f"{os.path.splitext(os.path.basename(self.beatmap))[0]} {time.strftime('%Y-%m-%d %H-%M-%S')}"
+        self.replay.save(os.path.join(directory, name + REPLAY_EXTENSION), self.beatmap)
+
+    def __end_early(self, key_state: int, map_time: float) -> None:
         """
         Функция, которая активизируется если игрок хочет досрочно закончить игру.
 
         :param key_state: Состяние клавишы
+        :param map_time: Время нажатия по времени карты в мс
 
         :return: None
         """
@@ -161,6 +264,14 @@ class Game:
             elif self.finished and not self.finished_early:
                 self.finished_score_screen = True
 
+    def __expose(self) -> None:
+        """
+        Окно снова показано (например, после сворачивания), и его нужно обновить целиком.
+
+        :return: None
+        """
+        self.full_redraw = True
+
     def __exit_game(self):
         """
         Меняет флажок self.exit на true, что приводит к завершению игры.
@@ -169,6 +280,104 @@ class Game:
         """
         self.exit = True
 
+    def set_track_state(self, track_number: int, key_state: int, map_time: float) -> None:
+        """
+        Передаёт нажатие или отпускание клавиши дорожке. Сначала все дорожки отмечают пропуски до map_time,
+        чтобы очки попадали в ScoreMaster в хронологическом порядке (от этого зависит комбо).
+        Событие оценивается по времени, с которым оно записывается в повтор (см. get_event_time),
+        чтобы пересчёт повтора давал те же очки. Время не раньше последнего шага ввода (см. judge):
+        при пересчёте пропуски отмечаются только по временам событий.
+
+        :param track_number: Номер дорожки
+        :param key_state: Состяние клавишы
+        :param map_time: Время события по времени карты в мс
+
+        :return: None
+        """
+        map_time = max(get_event_time(map_time), self.judged_time)
+        self.replay.record(track_number, key_state, map_time)
+        for track in self.tracks:
+            track.judge_misses(map_time)
+        self.tracks[track_number].set_state(key_state, map_time)
+
+    def judge(self, map_time: float) -> None:
+        """
+        Шаг ввода без событий: все дорожки отмечают пропуски до map_time, округлённого вниз до целых мс,
+        как времена событий в повторе. Следующие события оцениваются не раньше него (см. set_track_state),
+        так что пересчёт повтора отметит те же пропуски до тех же нажатий.
+
+        :param map_time: Время карты в мс
+
+        :return: None
+        """
+        map_time = self.judged_time = max(math.floor(map_time), self.judged_time)
+        for track in self.tracks:
+            track.judge_misses(map_time)
+
+    def collect_events(self) -> None:
+        """
+        Забирает события из очереди и помечает их временем, не обрабатывая (если игра запущена, см. start).
+        Обработаны и оценены они будут в следующем шаге ввода, так что кадр не меняет оценку посреди рисования
+
+        :return: None
+        """
+        if self.handler is not None:
+            self.handler.collect()
+
+    def draw_frame(self, map_time: float) -> None:
+        """
+        Рисует кадр на момент map_time и обновляет изменённые области дисплея
+
+        :param map_time: Время карты в мс
+
+        :return: None
+        """
+        map_position = get_scroll_position(self.scroll_table, map_time)
+        for track in self.tracks:
+            track.update(map_time, map_position)
+            # Кадр рисуется несколько мс, и всё это время шаг ввода не выполняется. Чтобы нажатия
+            # не помечались временем на кадр позже, события забираются (но не оцениваются) после каждой дорожки
+            self.collect_events()
+        self.profiler.lap('tracks')
+        dirty_rects = self.__render()
+        # С вертикальной синхронизацией (режим 'display', см. set_display_mode) показ ниже блокируется
+        # до обновления экрана, нажатия за это время получат время после показа. Всё, что пришло раньше,
+        # забирается до показа
+        self.collect_events()
+
+        if self.full_redraw:
+            pg.display.update()
+            self.full_redraw = False
+        else:
+            pg.display.update(dirty_rects)
+        self.profiler.lap('display')
+
+    def reset_screen(self) -> None:
+        """
+        Рисует фон на весь экран и обновляет дисплей целиком.
+        Дальше обновляются только изменённые области (см. draw_frame)
+
+        :return: None
+        """
+        self.surface.blit(self.bg_image, (0, 0))
+        pg.display.update()
+
+    def get_lead_in(self) -> float:
+        """
+        Если карта начинается слишком быстро, создает задержку для удобства.
+
+        :return: время в мс от начала игры до начала песни
+        """
+        return max(2000 - int(self.hitobjects[0]['time']), 0) if len(self.hitobjects) else 0
+
+    def get_map_time(self) -> float:
+        """
+        Возвращает текущее время карты
+
+        :return: время карты в мс (см. GameClock)
+        """
+        return self.clock.get_time()
+
     def start(self) -> int:
         """
         Начинает игру.
@@ -177,102 +386,147 @@ class Game:
         """
 
         # настройка обработчика событии
-        key_events = [(self.tracks[i].track_key, self.tracks[i].set_state) for i in range(self.track_count)] + \
-                     [(pg.K_ESCAPE, self.__end_early)]
-        handler = EventHandler([(pg.QUIT, self.__exit_game)], key_events)
+        key_events = [(self.tracks[i].track_key, partial(self.set_track_state, i))
+                      for i in range(self.track_count)] + \
+                     [(pg.K_ESCAPE, self.__end_early), (pg.K_F3, self.__toggle_profiler)]
+        handler = EventHandler([(pg.QUIT, self.__exit_game), (pg.WINDOWEXPOSED, self.__expose)], key_events,
+                               self.get_map_time)
+        self.handler = handler
 
         # Импортирование музыки
-        song = os.path.join(self.beatmap_folder, self.metadata['AudioFilename'])
+        song = get_local_path(os.path.join(self.beatmap_folder, self.metadata['AudioFilename']),
+                              os.path.join(self.game_config['Cache_directory'], 'audio'))
         player = audioplayer.AudioPlayer(song)
         player.volume = self.volume
 
-        render_start = 0
         FPS = self.game_config['FPS']
-        clock = pg.time.Clock()
+        # Ввод и оценка проверяются чаще, чем рисуются кадры (null - один раз за кадр)
+        input_rate = self.game_config.get('input_rate') or FPS
+        input_interval = 1000 / max(input_rate, FPS)
         map_duration = get_map_duration(self.hitobjects)
         music_started = False
 
-        # Если карта начинается слишком быстро, создает задержку для удобства.
-        if self.hitobjects[0]['time'] < 2000:
-            time_correction = 2000 - self.hitobjects[0]['time']
-        else:
-            time_correction = 0
-
-        self.surface.blit(self.bg_image, (0, 0))
-
-        start_time = time.time() * 1000
+        self.reset_screen()
+        self.clock.start(self.get_lead_in())
+        self.pacer.start()
+        self.profiler.start()
 
         while not self.finished:
-            current_time = time.time() * 1000
-            map_time = current_time - start_time - time_correction
+            # Шаг ввода: события клавиш оцениваются по своему времени, пропуски - по текущему
+            next_input = time.perf_counter() * 1000 + input_interval
+            handler.handle()
+            self.profiler.lap('events')
+            map_time = self.get_map_time()
+            self.judge(map_time)
+            self.profiler.lap('judge')
 
             if (not music_started) and map_time >= 0:
                 player.play()
                 music_started = True
-
-            render_start, render_end = get_objects_to_render(map_time, self.hitobjects, self.hitobject_count,
-                                                             self.fall_time, render_start)
-
-            for track in self.tracks:
-                track.update(map_time, self.hitobjects[render_start:render_end])
-            self.__render()
-            handler.handle()
-
-            pg.display.update()
-            clock.tick(FPS)
+            elif music_started and self.clock.need_sync():
+                self.clock.sync(get_playback_position(player))
+            self.profiler.lap('audio')
+
+            # Кадр рисуется, только когда подошло его время (см. FramePacer). Состояние меняет только шаг ввода
+            # (во время рисования события лишь забираются, см. collect_events), так что кадр всегда видит оценку целиком
+            frame_drawn = self.pacer.frame_due()
+            if frame_drawn:
+                self.draw_frame(map_time)
+                self.pacer.frame_drawn()
+
+            self.pacer.wait(next_input)
+            self.profiler.lap('sleep')
+            if frame_drawn:
+                self.profiler.end_frame()
 
             if map_time >= map_duration + 3000:
                 self.finished = True
 
             if self.exit:
+                self.save_profile()
+                self.save_replay()
                 return -1
 
+        self.save_profile()
+        self.save_replay()
+
         if not self.finished_early:
             end_screen = stats(self)
             self.surface.blit(end_screen, (0, 0))
+            pg.display.update()
+            self.menu_pacer.start()
             while not self.finished_score_screen:
-                handler.handle()
+                handler.handle(self.menu_pacer.get_events())
 
-                pg.display.update()
-                clock.tick(FPS)
+                # Экран результатов неподвижен, его нужно показать заново, только если окно было закрыто
+                if self.full_redraw or self.menu_pacer.mode != 'event':
+                    pg.display.update()
+                    self.full_redraw = False
+                self.menu_pacer.frame_drawn()
 
                 if self.exit:
                     return -1
 
         player.close()
+        logger.info('Audio offset: %s', f'{self.clock.offset:+.1f} ms' if self.clock.synced else 'not measured')
+        logger.info('Frame pacing: %s', self.pacer.get_report())
 
         return 0
 
 
 class EventHandler:
     """
-    Класс  -> Noneдля обработки событии.
+    Класс для обработки событии.
     """
 
     def __init__(self, regular_events: Sequence[Tuple[int, Callable]],
-                 key_events: Sequence[Tuple[int, Callable]]):
+                 key_events: Sequence[Tuple[int, Callable]], get_time: Callable[[], float]):
         """
         :param regular_events: Sequence[Tuple[int, Callable]] Выполняет Callable() при pg.event.Event
-        :param key_events: Sequence[Tuple[int, Callable]] Выполняет Callable(key_state) если клавиша key зажата
+        :param key_events: Sequence[Tuple[int, Callable]] Выполняет Callable(key_state, time)
+                           при нажатии (key_state = 1) и отпускании (key_state = 0) клавиши key
+        :param get_time: возвращает текущее время, которым помечаются события клавиш
         """
 
         self.regular_events_types: [int] = [regular_events[i][0] for i in range(len(regular_events))]
         self.regular_events_functions: [Callable] = [regular_events[i][1] for i in range(len(regular_events))]
 
-        self.keys: [int] = [key_events[i][0] for i in range(len(key_events))]
-        self.key_functions: [Callable] = [key_events[i][1] for i in range(len(key_events))]
+        # Одна клавиша может быть назначена нескольким дорожкам (например, в settings['6k_keys']),
+        # тогда событие получают все её функции
+        self.key_functions: dict = dict()
+        for key, function in key_events:
+            self.key_functions.setdefault(key, []).append(function)
+        self.get_time = get_time
+        # Забранные из очереди, но ещё не обработанные события с их временем (см. collect)
+        self.pending: List[Tuple[pg.event.Event, float]] = []
 
-    def handle(self) -> None:
+    def collect(self, events: List[pg.event.Event] = None) -> None:
         """
-        Обрабатывает события.
+        Забирает события и помечает их текущим временем, не обрабатывая. pygame не сообщает время события,
+        поэтому события помечаются временем, в которое они забраны из очереди. Обработает их handle.
 
+        :param events: уже забранные из очереди события (None - забрать самому)
         :return: None
         """
-        for event in pg.event.get():
-            if event.type in self.regular_events_types:
-                self.regular_events_functions[self.regular_events_types.index(event.type)]()
+        if events is None:
+            events = pg.event.get()
+        event_time = self.get_time()
+        self.pending += [(event, event_time) for event in events]
 
-        key_states = pg.key.get_pressed()
+    def handle(self, events: List[pg.event.Event] = None) -> None:
+        """
+        Обрабатывает события: сначала собранные раньше (см. collect), потом новые. События клавиш
+        обрабатываются по порядку, так что нажатие и отпускание между двумя вызовами не теряются.
+
+        :param events: уже забранные из очереди события (None - забрать самому)
+        :return: None
+        """
+        self.collect(events)
+        pending, self.pending = self.pending, []
 
-        for i, key in enumerate(self.keys):
-            self.key_functions[i](key_states[key])
+        for event, event_time in pending:
+            if event.type in self.regular_events_types:
+                self.regular_events_functions[self.regular_events_types.index(event.type)]()
+            elif event.type in (pg.KEYDOWN, pg.KEYUP) and event.key in self.key_functions:
+                for function in self.key_functions[event.key]:
+                    function(int(event.type == pg.KEYDOWN), event_time)
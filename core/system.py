@@ -1,5 +1,6 @@
 import os
 import json
+import logging
 from typing import Callable
 
 import pygame
@@ -13,9 +14,11 @@ from utils.ui_objects import (
     DropDownList,
     smartscale
 )
-from utils.beatmap_utils import (
-    get_beatmaps
-)
+from utils.library import BeatmapLibrary
+from utils.song_index import SongIndex, SORT_KEYS
+from utils.frame_pacer import FramePacer, set_display_mode
+
+logger = logging.getLogger(__name__)
 
 
 class System:
@@ -26,11 +29,18 @@ class System:
         with open('./settings/game_config.json', 'r') as f:
             sets = json.load(f)
 
-        self.screen = pygame.display.set_mode((sets['width'], sets['height']))
+        self.menu_pacing = sets.get('menu_pacing', 'event')
+        self.menu_FPS = sets.get('menu_FPS', 60)
+        vsync = 'display' in (self.menu_pacing, sets.get('game_pacing'))
+
+        self.screen = set_display_mode((sets['width'], sets['height']), vsync)
         self.width, self.height = sets['width'], sets['height']
 
         self.FPS = sets['FPS']
         self.Beatmaps_directory = sets['Beatmaps_directory']
+        self.Library_index = sets['Library_index']
+        self.Cache_directory = sets['Cache_directory']
+        self.scan_workers = sets['scan_workers']
         self.assets_directory = sets['assets_directory']
         self.sets = {'volume': sets['volume']}
         self.objects = []
@@ -57,6 +67,11 @@ class System:
         self.place = None
         self.last_place = None
 
+        self.library = BeatmapLibrary(self.Beatmaps_directory, self.Library_index)
+        self.song_index = SongIndex()
+        self.search_query = ''
+        self.sort_key = SORT_KEYS[0]
+
         self.menu_objects = self.get_menu()
         self.settings_objects = self.get_settings()
         self.start_objects = self.get_start()
@@ -148,11 +163,12 @@ class System:
 
         return [menu_box, volume, volume_slider, _exit, bg] + bg_buttons
 
-    def get_start(self) -> list:
-        folder = self.assets_directory
-        const = self.constants['start']
-        # take information about tracks into files:
-        beatmaps = get_beatmaps(self.Beatmaps_directory)
+    def get_songs(self, beatmaps: list) -> list:
+        """
+        Make drop_down format objects for songs
+        :param beatmaps: list of beatmap sets from library (see get_beatmap_set)
+        :return: list of songs for DropDownList
+        """
         objects = []
 
         # add songs into drop_down format:
@@ -164,14 +180,25 @@ class System:
             song.append(file)
             for dif in beat_map['diffs']:
                 file = {'music': beat_map['music_path'], 'type': 'not_main', 'bg_image': beat_map['bg_image'],
-                        'preview': beat_map['preview'], 'text': str(list(dif.keys())[0]),
+                        'preview': beat_map['preview'], 'text': f"{dif['version']} ({dif['stars']:.2f}*)",
                         'rect_image': os.path.join(self.assets_directory, 'rect_image.jpg')}
-                diff = dif[str(list(dif.keys())[0])]
-                file['func'] = [self.start_game, self.screen, beat_map['beatmap_directory'], diff]
+                file['func'] = [self.start_game, self.screen, beat_map['beatmap_directory'], dif['file']]
                 song.append(file)
 
             objects.append(song)
 
+        return objects
+
+    def get_start(self) -> list:
+        folder = self.assets_directory
+        const = self.constants['start']
+        # take information about tracks into files, changed folders are read in background:
+        self.library.start_scan(self.scan_workers)
+        beatmaps = [beat_map for beat_map in self.library.get_beatmaps() if beat_map['diffs']]
+        for beat_map in beatmaps:
+            self.song_index.add(beat_map)
+        objects = self.get_songs(beatmaps)
+
         _map = DropDownList((self.width * const['drop_down_list'][0], self.height * const['drop_down_list'][1]),
                             os.path.join(self.assets_directory, 'arrow.png'), self.constants['font'],
                             'black', objects, self.constants, self, self.audio_player,
@@ -185,8 +212,59 @@ class System:
             box_size=self.constants['box_size'],
             size=(int(self.width * const['settings_size']), int(self.width * const['settings_size'])))
 
+        # search line, type to search:
+        self.search_box = TextBox((self.width * const['search'][0], self.height * const['search'][1]),
+                                  const['search_font'], self.constants['colors']['textbox'], '', 'left',
+                                  os.path.join(folder, 'rect_image.jpg'),
+                                  size=(int(self.width * const['search_size'][0]),
+                                        int(self.height * const['search_size'][1])))
+
         # WARNING: First argument must be _map, as it is used in method start!
-        return [_map, setting]
+        return [_map, setting, self.search_box]
+
+    def update_library(self) -> bool:
+        """
+        Add songs which were read by library scan since last call to the song list
+        :return: True if any songs were added
+        """
+        new_sets = [beat_map for beat_map in self.library.poll() if beat_map['diffs']]
+        if new_sets:
+            for beat_map in new_sets:
+                self.song_index.add(beat_map)
+            self.start_objects[0].add(self.get_songs(new_sets))
+            # apply_search closes opened songs which are not found any more, which removes their info boxes
+            # from self.objects, so it is only safe on the start screen; start() applies the search when it is opened
+            if self.place == self.start:
+                self.apply_search()
+        return bool(new_sets)
+
+    def search_input(self, event: pygame.event.Event) -> None:
+        """
+        Edit search query by key press: printable keys are typed, Backspace deletes,
+        Delete clears query, Tab changes sorting
+        :param event: pygame KEYDOWN event
+        :return: None
+        """
+        if event.key == pygame.K_BACKSPACE:
+            self.search_query = self.search_query[:-1]
+        elif event.key == pygame.K_DELETE:
+            self.search_query = ''
+        elif event.key == pygame.K_TAB:
+            self.sort_key = SORT_KEYS[(SORT_KEYS.index(self.sort_key) + 1) % len(SORT_KEYS)]
+        elif event.unicode and event.unicode.isprintable():
+            self.search_query += event.unicode
+        else:
+            return
+
+        self.apply_search()
+
+    def apply_search(self) -> None:
+        """
+        Show only songs matching search query, sorted by current sort key
+        :return: None
+        """
+        self.start_objects[0].show(self.song_index.search(self.search_query, self.sort_key))
+        self.search_box.text = f'Search: {self.search_query}_   Sort (Tab): {self.sort_key}'
 
     def menu(self) -> None:
         self.place = self.menu
@@ -204,6 +282,7 @@ class System:
         self.place = self.start
         self.funtions_to_call = [self.start_objects[0].mute]
         self.objects = self.start_objects
+        self.apply_search()
 
     def switch(self, destination: Callable) -> None:
         self.last_place = self.place
@@ -218,10 +297,9 @@ class System:
 
     def play(self) -> None:
         # start menu-window
-        FPS = self.FPS
+        pacer = FramePacer(self.menu_pacing, self.menu_FPS)
 
         pygame.display.update()
-        clock = pygame.time.Clock()
         if self.first_time:
             self.menu()
             self.start_music_player.volume = int(100 * self.sets['volume'])
@@ -229,12 +307,17 @@ class System:
         else:
             self.start()
 
+        pacer.start()
         while not self.finished:
-            clock.tick(FPS)
+            events = pacer.get_events()
+            # in 'event' pacing the menu is redrawn only when something could have changed
+            redraw = self.update_library() or bool(events) or pacer.mode != 'event'
 
-            for event in pygame.event.get():
+            for event in events:
                 if event.type == pygame.QUIT:
                     self.finished = True
+                if event.type == pygame.KEYDOWN and self.place == self.start:
+                    self.search_input(event)
                 for obj in self.objects:
                     if type(obj) != TextBox:
                         obj.click(event)
@@ -244,12 +327,19 @@ class System:
             else:
                 self.start_music_player.pause()
 
+            if not redraw:
+                continue
+
             # draw objects:
             self.screen.blit(self.bg_surface, (0, 0))
             for obj in self.objects:
                 self.screen.blit(obj.get_surface(), obj.position)
 
             pygame.display.update()
+            pacer.frame_drawn()
+
+        logger.info('Menu frame pacing: %s', pacer.get_report())
+        self.library.close()
         pygame.quit()
 
     def exit_screensaver(self) -> None:
@@ -258,9 +348,12 @@ class System:
         game_config['volume'] = self.sets['volume']
         with open('./settings/game_config.json', 'w') as f:
             json.dump(game_config, f, indent=4)
+        self.library.close()
         exit()
 
     def start_game(self, screen: pygame.Surface, beat_map: str, diff: str) -> None:
+        # the scan goes on during the game, songs read so far are saved in case the game is closed
+        self.library.save_changes()
         self.audio_player.close()
         self.start_music_player.close()
         self.in_menu = False
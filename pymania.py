@@ -1,5 +1,12 @@
+import json
+import logging
+
 from core.system import System
 
 if __name__ == '__main__':
+    with open('./settings/game_config.json', 'r') as f:
+        # Отчёты о расхождении со звуком и ритме кадров пишутся в лог на уровне INFO
+        logging.basicConfig(level=json.load(f).get('log_level', 'WARNING'), format='%(name)s: %(message)s')
+
     system = System()
     system.play()
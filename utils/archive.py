@@ -0,0 +1,185 @@
+import io
+import os
+import json
+import zipfile
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Tuple, Union, IO, List
+
+# Файлы карт внутри архива .osz адресуются как обычные пути, например "./beatmaps/123 Song.osz/bg.jpg"
+ARCHIVE_EXTENSION = '.osz'
+
+
+def is_archive(path: str) -> bool:
+    """
+    :param path: путь
+    :return: True, если это архив карты .osz
+    """
+    return path.lower().endswith(ARCHIVE_EXTENSION) and os.path.isfile(path)
+
+
+def split_archive_path(path: str) -> Union[Tuple[str, str], None]:
+    """
+    Разделяет путь к файлу внутри архива .osz на путь архива и имя файла в архиве
+
+    :param path: путь к файлу
+    :return: (путь архива, имя файла в архиве) или None, если путь не ведёт внутрь архива
+    """
+    if ARCHIVE_EXTENSION not in path.lower():
+        return None
+
+    head = path
+    while True:
+        if is_archive(head):
+            if head == path:
+                return None
+            return head, os.path.relpath(path, head).replace(os.sep, '/')
+
+        new_head = os.path.dirname(head)
+        if new_head == head:
+            return None
+        head = new_head
+
+
+def open_resource(path: str) -> IO[bytes]:
+    """
+    Открывает файл на чтение в бинарном режиме, в том числе файл внутри архива .osz (без распаковки на диск)
+
+    :param path: путь к файлу
+    :return: файловый объект
+    """
+    archive_path = split_archive_path(path)
+    if archive_path is None:
+        return open(path, 'rb')
+
+    archive, member = archive_path
+    with zipfile.ZipFile(archive) as zf:
+        return io.BytesIO(zf.read(member))
+
+
+def open_text(path: str) -> IO[str]:
+    """
+    Открывает текстовый файл (.osu) на чтение, в том числе файл внутри архива .osz
+
+    :param path: путь к файлу
+    :return: текстовый файловый объект
+    """
+    return io.TextIOWrapper(open_resource(path), encoding='utf-8-sig')
+
+
+def get_resource_stat(path: str) -> Tuple[int, int]:
+    """
+    Возвращает mtime (нс) и размер файла. Для файла в архиве mtime берётся у архива, а размер - у файла в архиве.
+
+    :param path: путь к файлу
+    :return: mtime, size
+    """
+    archive_path = split_archive_path(path)
+    if archive_path is None:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+
+    archive, member = archive_path
+    with zipfile.ZipFile(archive) as zf:
+        return os.stat(archive).st_mtime_ns, zf.getinfo(member).file_size
+
+
+def list_files(set_path: str) -> List[str]:
+    """
+    Возвращает имена файлов папки карты или архива .osz
+
+    :param set_path: путь к папке или архиву
+    :return: список имён файлов
+    """
+    if is_archive(set_path):
+        with zipfile.ZipFile(set_path) as zf:
+            return [name for name in zf.namelist() if not name.endswith('/')]
+
+    return os.listdir(set_path)
+
+
+def get_local_path(path: str, extract_directory: str) -> str:
+    """
+    Возвращает путь к файлу на диске. Файл из архива .osz распаковывается (один, а не весь архив)
+    в extract_directory, если его там ещё нет или архив изменился.
+    Нужно для библиотек, которые умеют открывать только файлы на диске (например, audioplayer).
+
+    :param path: путь к файлу
+    :param extract_directory: папка для распакованных файлов
+    :return: путь к файлу на диске
+    """
+    archive_path = split_archive_path(path)
+    if archive_path is None:
+        return path
+
+    archive, member = archive_path
+    local_path = os.path.join(extract_directory, os.path.basename(archive), *member.split('/'))
+
+    if not os.path.exists(local_path) or os.path.getmtime(local_path) < os.path.getmtime(archive):
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with zipfile.ZipFile(archive) as zf, zf.open(member) as src, open(local_path + '.tmp', 'wb') as dst:
+            while True:
+                chunk = src.read(2 ** 20)
+                if not chunk:
+                    break
+                dst.write(chunk)
+        os.replace(local_path + '.tmp', local_path)
+
+    return local_path
+
+
+def extract_archive(archive: str, beatmaps_folder: str) -> str:
+    """
+    Распаковывает архив .osz в отдельную папку в папке с картами
+
+    :param archive: путь к архиву
+    :param beatmaps_folder: папка с картами
+    :return: путь папки карты
+    """
+    name = os.path.basename(archive)[:-len(ARCHIVE_EXTENSION)]
+    map_directory = os.path.join(beatmaps_folder, name)
+
+    with zipfile.ZipFile(archive) as zf:
+        zf.extractall(map_directory)
+
+    return map_directory
+
+
+def import_archives(archives: List[str], beatmaps_folder: str, workers: Union[int, None] = None) -> None:
+    """
+    Распаковывает много архивов .osz параллельно в пуле процессов.
+    Ошибка в одном архиве не прерывает импорт остальных.
+
+    :param archives: пути к архивам
+    :param beatmaps_folder: папка с картами
+    :param workers: количество процессов (None - по количеству ядер)
+    :return: None
+    """
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {executor.submit(extract_archive, archive, beatmaps_folder): archive for archive in archives}
+
+        for future in as_completed(futures):
+            try:
+                print(f'Imported {future.result()}')
+            except (OSError, zipfile.BadZipFile) as e:
+                print(f'Failed to import {futures[future]}: {e}')
+
+
+def main() -> None:
+    with open('./settings/game_config.json', 'r') as f:
+        game_config = json.load(f)
+
+    parser = argparse.ArgumentParser(description='Extract .osz archives into the beatmaps directory. '
+                                                 'Not required: the game reads .osz archives in place.')
+    parser.add_argument('archives', nargs='+', help='.osz files to import')
+    parser.add_argument('--beatmaps', default=game_config['Beatmaps_directory'],
+                        help='beatmaps directory (default: %(default)s)')
+    parser.add_argument('--jobs', type=int, default=None, help='number of worker processes (default: all cores)')
+    args = parser.parse_args()
+
+    import_archives(args.archives, args.beatmaps, args.jobs)
+
+
+if __name__ == '__main__':
+    main()
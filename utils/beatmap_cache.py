@@ -0,0 +1,229 @@
+import os
+import json
+import shutil
+import hashlib
+import argparse
+from typing import Tuple, Dict, Union
+
+import numpy as np
+
+from utils.beatmap_utils import Beatmap, compile_beatmap
+from utils.archive import get_resource_stat, is_archive, list_files
+
+# Меняется при изменении формата скомпилированной карты, старые записи кэша при этом игнорируются
+CACHE_VERSION = 3
+
+INFO_FILE = 'info.json'
+
+
+class BeatmapCache:
+    """
+    Кэш скомпилированных карт на диске.
+
+    Каждая карта хранится в отдельной папке: info.json с метаданными и отпечатком исходного файла
+    (mtime и размер) и по одному .npy файлу на каждый массив карты. Массивы открываются через memory map,
+    поэтому повторный запуск карты не парсит .osu заново. Время последнего использования записи -
+    mtime её info.json, по нему вытесняются самые старые записи при превышении лимита размера.
+    """
+
+    def __init__(self, directory: str, size_limit: int = 256 * 2 ** 20):
+        """
+        :param directory: папка кэша
+        :param size_limit: максимальный размер кэша в байтах
+        """
+        self.directory = directory
+        self.size_limit = size_limit
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    def get_entry_directory(self, file: str) -> str:
+        """
+        Возвращает папку записи кэша для заданного файла карты
+
+        :param file: путь к файлу карты
+        :return: путь папки записи
+        """
+        key = hashlib.sha1(os.path.abspath(file).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key)
+
+    @staticmethod
+    def get_fingerprint(file: str) -> dict:
+        """
+        Возвращает отпечаток файла карты, по которому проверяется актуальность записи
+
+        :param file: путь к файлу карты
+        :return: словарик с версией кэша, путём, mtime и размером файла
+        """
+        mtime, size = get_resource_stat(file)
+        return {'version': CACHE_VERSION, 'source': os.path.abspath(file), 'mtime': mtime, 'size': size}
+
+    def load(self, file: str) -> Tuple[dict, Dict[str, np.ndarray]]:
+        """
+        Возвращает скомпилированную карту из кэша, компилируя и сохраняя её, если записи нет или она устарела.
+        Массивы открываются в режиме copy-on-write, так что их можно менять не затрагивая кэш.
+
+        :param file: путь к файлу карты
+        :return: metadata, arrays (см. compile_beatmap)
+        """
+        entry = self.get_entry_directory(file)
+        fingerprint = self.get_fingerprint(file)
+
+        info = self.read_info(entry)
+        if info is not None and info['fingerprint'] == fingerprint:
+            try:
+                arrays = {name: np.load(os.path.join(entry, f'{name}.npy'), mmap_mode='c')
+                          for name in info['arrays']}
+            except (OSError, ValueError):
+                pass
+            else:
+                # Отмечаем использование записи для LRU
+                os.utime(os.path.join(entry, INFO_FILE))
+                return info['metadata'], arrays
+
+        metadata, arrays = compile_beatmap(file)
+        self.store(entry, fingerprint, metadata, arrays)
+
+        return metadata, arrays
+
+    @staticmethod
+    def read_info(entry: str) -> Union[dict, None]:
+        """
+        Читает info.json записи кэша
+
+        :param entry: папка записи
+        :return: словарик из info.json или None, если записи нет или она повреждена
+        """
+        try:
+            with open(os.path.join(entry, INFO_FILE), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def store(self, entry: str, fingerprint: dict, metadata: dict, arrays: Dict[str, np.ndarray]) -> None:
+        """
+        Сохраняет скомпилированную карту в кэш и вытесняет старые записи, если кэш превысил лимит.
+        info.json пишется последним, поэтому недописанная запись никогда не считается актуальной.
+
+        :param entry: папка записи
+        :param fingerprint: отпечаток файла карты (см. get_fingerprint)
+        :param metadata: метаданные карты
+        :param arrays: массивы карты
+        :return: None
+        """
+        os.makedirs(entry, exist_ok=True)
+
+        for name, array in arrays.items():
+            np.save(os.path.join(entry, f'{name}.npy'), array)
+
+        info = {'fingerprint': fingerprint, 'metadata': metadata, 'arrays': list(arrays.keys())}
+        tmp_path = os.path.join(entry, INFO_FILE + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(info, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(entry, INFO_FILE))
+
+        self.evict(keep=entry)
+
+    def evict(self, keep: str = None) -> None:
+        """
+        Удаляет давно не использованные записи, пока размер кэша больше лимита
+
+        :param keep: папка записи, которую удалять нельзя (только что записанная)
+        :return: None
+        """
+        entries = []
+        total_size = 0
+
+        for name in os.listdir(self.directory):
+            entry = os.path.join(self.directory, name)
+            if not os.path.isdir(entry):
+                continue
+
+            size = sum(os.path.getsize(os.path.join(entry, file)) for file in os.listdir(entry))
+            info_path = os.path.join(entry, INFO_FILE)
+            last_used = os.path.getmtime(info_path) if os.path.exists(info_path) else 0
+
+            entries.append((last_used, size, entry))
+            total_size += size
+
+        entries.sort()
+
+        for last_used, size, entry in entries:
+            if total_size <= self.size_limit:
+                break
+            if keep is not None and os.path.samefile(entry, keep):
+                continue
+
+            try:
+                shutil.rmtree(entry)
+            except OSError:
+                # Запись может быть открыта через memory map (например, на Windows)
+                continue
+            total_size -= size
+
+
+def get_cache(game_config: dict) -> BeatmapCache:
+    """
+    Создает кэш карт по настройкам игры
+
+    :param game_config: словарик из game_config.json
+    :return: BeatmapCache
+    """
+    return BeatmapCache(os.path.join(game_config['Cache_directory'], 'beatmaps'),
+                        game_config['cache_size_limit'] * 2 ** 20)
+
+
+def prewarm(cache: BeatmapCache, beatmaps_folder: str) -> Tuple[int, int]:
+    """
+    Компилирует в кэш все mania карты из папки с картами (включая архивы .osz).
+    Режим карты определяется по заголовку файла, остальные карты не компилируются.
+    Файл, который не удалось прочитать, пропускается, остальные компилируются дальше.
+
+    :param cache: кэш карт
+    :param beatmaps_folder: папка с картами
+    :return: количество скомпилированных карт и количество файлов, которые не удалось прочитать
+    """
+    compiled = skipped = 0
+
+    for map_ in sorted(os.listdir(beatmaps_folder)):
+        map_directory = os.path.join(beatmaps_folder, map_)
+        if not os.path.isdir(map_directory) and not is_archive(map_directory):
+            continue
+
+        for beatmap in sorted(list_files(map_directory)):
+            if not beatmap.endswith('.osu'):
+                continue
+
+            path = os.path.join(map_directory, beatmap)
+            try:
+                if not Beatmap(path).is_mania():
+                    continue
+                cache.load(path)
+            except Exception as e:
+                print(f'Skipped {beatmap}: {type(e).__name__}: {e}')
+                skipped += 1
+            else:
+                compiled += 1
+
+    return compiled, skipped
+
+
+def main() -> None:
+    with open('./settings/game_config.json', 'r') as f:
+        game_config = json.load(f)
+
+    parser = argparse.ArgumentParser(description='Pre-compile beatmaps into the on-disk cache.')
+    parser.add_argument('beatmaps', nargs='?', default=game_config['Beatmaps_directory'],
+                        help='beatmaps directory (default: %(default)s)')
+    parser.add_argument('--cache', default=game_config['Cache_directory'],
+                        help='cache directory (default: %(default)s)')
+    parser.add_argument('--limit', type=int, default=game_config['cache_size_limit'],
+                        help='cache size limit in MB (default: %(default)s)')
+    args = parser.parse_args()
+
+    cache = BeatmapCache(os.path.join(args.cache, 'beatmaps'), args.limit * 2 ** 20)
+    compiled, skipped = prewarm(cache, args.beatmaps)
+    print(f'Compiled {compiled} beatmaps, skipped {skipped}')
+
+
+if __name__ == '__main__':
+    main()
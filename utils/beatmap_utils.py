@@ -1,186 +1,396 @@
 import os
-from typing import Union
+from typing import Union, Tuple, Dict, List
 
 import numpy as np
 
+from utils.archive import open_text, list_files, is_archive
+from utils.difficulty import get_star_rating
 
-def parse_hitobject(track_count: int, s: str) -> dict:
+
+# Коды типов объектов в поле 'type'
+NOTE = 0
+HOLD = 1
+
+# Секции, содержимое которых - список строк, а не пары "ключ: значение"
+LIST_SECTIONS = ('Events', 'TimingPoints', 'HitObjects')
+
+# Секции с метаданными, которые идут в файле до [Events]
+HEADER_SECTIONS = ('General', 'Metadata', 'Difficulty')
+
+# Колоночное представление объектов карты (см. parse_hitobject)
+HITOBJECT_DTYPE = np.dtype([
+    ('x', np.int8),
+    ('time', np.int32),
+    ('endTime', np.int32),
+    ('type', np.int8),
+    ('hitSound', np.int8),
+    ('score', np.int16),
+    ('position', np.float64),
+    ('endPosition', np.float64),
+])
+
+# Границы множителя скорости прокрутки (SV)
+MIN_SCROLL_VELOCITY = 0.01
+MAX_SCROLL_VELOCITY = 10.
+
+
+def parse_hitobject(track_count: int, s: str) -> tuple:
     """
-    Парсит строку с информацией об объекте в словарик
+    Парсит строку с информацией об объекте в запись для HITOBJECT_DTYPE
     :param track_count:
     Количество дорожек
     :param s:
     Строка с информацией вида "x,y,time,type,hitSound,endTime,hitSample"
     :return:
-    Словарик с полями
+    Кортеж с полями
     'x' - номер дорожки (начиная с 0)
     'time' - ожидаемое время нажатия объекта в мс
-    'hitsound' - какой хитсаунд играть
-    'type' - тип объекта note или hold
-    'endTime' - (if type=hold) ожидаемое время отпускания холда в мс
+    'endTime' - ожидаемое время отпускания холда в мс (для нот совпадает с 'time')
+    'type' - тип объекта NOTE или HOLD
+    'hitSound' - какой хитсаунд играть
     'score' - количество очков полученных за данную ноту (default -1)
+    'position', 'endPosition' - положение начала и конца объекта на ленте прокрутки
+    (заполняются в read_beatmap, см. get_scroll_table)
     """
 
-    object_params = list(s.strip().split(','))
+    object_params = s.strip().split(',')
 
-    obj = dict()
-    obj['x'] = int(round(int(object_params[0]) * track_count / 512 - 0.5))
-    obj['time'] = int(object_params[2])
-    obj['hitSound'] = int(object_params[4])
+    x = int(round(int(object_params[0]) * track_count / 512 - 0.5))
+    time = int(object_params[2])
+    hit_sound = int(object_params[4])
 
     type_flag = int(object_params[3])
 
     if type_flag & 0b00000001:
-        obj['type'] = 'note'
+        return x, time, time, NOTE, hit_sound, -1, 0., 0.
     elif type_flag & 0b10000000:
-        obj['type'] = 'hold'
-        obj['endTime'] = int(object_params[5].split(':')[0])
+        end_time = int(object_params[5].split(':')[0])
+        return x, time, end_time, HOLD, hit_sound, -1, 0., 0.
     else:
         raise ValueError('Make Sure this is osu!mania map.')
 
-    obj['score'] = -1
-
-    return obj
-
 
-def get_metadata(file: str) -> dict:
+def read_beatmap(file: str, header_only: bool = False) -> dict:
     """
-    Парсит метаданные заданной карты.
+    Читает файл карты за один проход по строкам.
+    Понимает CRLF переводы строк и секции без пустой строки между ними.
 
     :param file:
-    путь к файлу карты
+    путь к файлу карты (может вести внутрь архива .osz, см. utils.archive)
+    :param header_only:
+    читать только заголовок (HEADER_SECTIONS и [Events] до фона). Чтение останавливается, как только
+    найден фон или началась [TimingPoints]/[HitObjects], так что так можно читать и не mania карты
     :return:
-    словарик с метаданными (числовые значения не переведены в float/int)
-    (Секции [General], [Metadata], [Difficulty], Background из [Events])
+    словарик {название секции: содержимое}
+    Секции вида "ключ: значение" ([General], [Editor], [Metadata], [Difficulty], [Colours]) - словарики
+    (числовые значения не переведены в float/int),
+    [Events] и [TimingPoints] - списки строк, разбитых по запятым,
+    [HitObjects] - np.array (HITOBJECT_DTYPE, см. parse_hitobject)
     https://osu.ppy.sh/wiki/en/osu%21_File_Formats/Osu_%28file_format%29
     """
-    with open(file, 'r') as f:
-        data = f.readlines()
-        metadata = dict()
-
-        i = data.index('[General]\n') + 1
-        while data[i] != '\n':
-            key, val = data[i].split(':')
-            metadata[key] = val.strip()
-            i += 1
-
-        i = data.index('[Metadata]\n') + 1
-        while data[i] != '\n':
-            key, val = data[i].split(':')
-            metadata[key] = val.strip()
-            i += 1
-
-        i = data.index('[Difficulty]\n') + 1
-        while data[i] != '\n':
-            key, val = data[i].split(':')
-            metadata[key] = val.strip()
-            i += 1
-
-        i = data.index('[Events]\n') + 1
-        while data[i] != '\n':
-            if not data[i].startswith('//'):
-                event = data[i].split(',')
-
-                if event[0] == event[1] == '0':
-                    metadata['Background'] = event[2][1:-1]
+    sections = dict()
+    section = None
+    content = None
+
+    with open_text(file) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('//'):
+                continue
+
+            if line[0] == '[' and line[-1] == ']':
+                section = line[1:-1]
+                if header_only and section in ('TimingPoints', 'HitObjects'):
+                    break
+                content = [] if section in LIST_SECTIONS else dict()
+                sections[section] = content
+            elif section is None:
+                # Строка "osu file format vXX"
+                continue
+            elif section in LIST_SECTIONS:
+                content.append(line)
+                if header_only and section == 'Events' and line.startswith('0,0,') and \
+                        all(header in sections for header in HEADER_SECTIONS):
                     break
-            i += 1
+            else:
+                key, _, val = line.partition(':')
+                content[key.strip()] = val.strip()
+
+    for section in ('Events', 'TimingPoints'):
+        sections[section] = [line.split(',') for line in sections.get(section, [])]
+
+    if header_only:
+        return sections
+
+    track_count = int(sections.get('Difficulty', {}).get('CircleSize', 0))
+    hitobjects = np.array([parse_hitobject(track_count, line) for line in sections.get('HitObjects', [])],
+                          dtype=HITOBJECT_DTYPE)
+
+    scroll_table = get_scroll_table(sections['TimingPoints'])
+    hitobjects['position'] = get_scroll_position(scroll_table, hitobjects['time'])
+    hitobjects['endPosition'] = get_scroll_position(scroll_table, hitobjects['endTime'])
+    sections['HitObjects'] = hitobjects
+
+    return sections
+
+
+def get_scroll_table(timing_points: list) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Строит таблицу "пройденное лентой прокрутки расстояние от времени" по точкам тайминга.
+    Скорость прокрутки равна 1 после uninherited точки и SV (-100 / beatLength) после inherited,
+    смена BPM на скорость не влияет. Без изменений SV положение на ленте совпадает со временем в мс.
+
+    :param timing_points: список точек из секции [TimingPoints] (строки, разбитые по запятым)
+    :return: times, positions, velocities - начала участков постоянной скорости,
+    положение на ленте в начале каждого участка и скорость на участке
+    """
+    points = []
+    for point in timing_points:
+        time = float(point[0])
+        beat_length = float(point[1])
+        # В старом формате поля uninherited нет, inherited точки там отличаются отрицательной длиной доли
+        uninherited = point[6] == '1' if len(point) > 6 else beat_length >= 0
+
+        if uninherited or beat_length >= 0:
+            velocity = 1.
         else:
-            metadata['Background'] = None
+            velocity = min(max(-100 / beat_length, MIN_SCROLL_VELOCITY), MAX_SCROLL_VELOCITY)
+        points.append((time, velocity))
+
+    if not points:
+        return np.zeros(1), np.zeros(1), np.ones(1)
+
+    # Точки с одинаковым временем: действует последняя в файле
+    points.sort(key=lambda point: point[0])
+    times = np.array([point[0] for point in points])
+    velocities = np.array([point[1] for point in points])
+
+    positions = np.empty_like(times)
+    positions[0] = times[0]
+    positions[1:] = times[0] + np.cumsum(np.diff(times) * velocities[:-1])
+
+    return times, positions, velocities
+
+
+def get_scroll_position(scroll_table: Tuple[np.ndarray, np.ndarray, np.ndarray],
+                        time: Union[float, np.ndarray]) -> Union[float, np.ndarray]:
+    """
+    Возвращает положение на ленте прокрутки для заданного времени:
+    бинарный поиск участка и одно умножение со сложением
+
+    :param scroll_table: times, positions, velocities (см. get_scroll_table)
+    :param time: время карты в мс (число или np.array)
+    :return: положение на ленте (число или np.array)
+    """
+    times, positions, velocities = scroll_table
+    i = np.maximum(np.searchsorted(times, time, side='right') - 1, 0)
 
-        return metadata
+    return positions[i] + (time - times[i]) * velocities[i]
 
 
-def get_hitobjects(file: str) -> np.array:
+def get_background(events: list) -> Union[str, None]:
+    """
+    Ищет фоновое изображение среди событий карты
+
+    :param events: список событий из секции [Events] (строки, разбитые по запятым)
+    :return: имя файла фона или None, если его нет
+    """
+    for event in events:
+        if len(event) > 2 and event[0] == event[1] == '0':
+            return event[2].strip('"')
+
+    return None
+
+
+def extract_metadata(sections: dict) -> dict:
+    """
+    Собирает метаданные из секций, прочитанных read_beatmap.
+
+    :param sections: словарик секций карты
+    :return:
+    словарик с метаданными (числовые значения не переведены в float/int)
+    (Секции [General], [Metadata], [Difficulty], Background из [Events])
+    """
+    metadata = dict()
+
+    for section in HEADER_SECTIONS:
+        metadata.update(sections.get(section, {}))
+
+    metadata['Background'] = get_background(sections.get('Events', []))
+
+    return metadata
+
+
+def get_metadata(file: str) -> dict:
+    """
+    Парсит метаданные заданной карты, читая только заголовок файла.
+
+    :param file:
+    путь к файлу карты
+    :return:
+    словарик с метаданными (см. extract_metadata)
+    """
+    return extract_metadata(read_beatmap(file, header_only=True))
+
+
+def get_hitobjects(file: str) -> np.ndarray:
     """
     Парсит объекты из файла карты.
 
     :param file:
     путь к файлу карты
     :return:
-    Возвращает список всех объектов(в виде словарикв, см. parse_hitobjects) в хронологическом порядке
+    Возвращает структурированный np.array (HITOBJECT_DTYPE, см. parse_hitobject) всех объектов
+    в хронологическом порядке
     """
+    return read_beatmap(file)['HitObjects']
 
-    with open(file, 'r') as f:
-        data = f.readlines()
 
-        i = data.index('[Difficulty]\n') + 1
-        while data[i] != '\n':
-            key, val = data[i].split(':')
-            if key == 'CircleSize':
-                track_count = int(val)
-                break
-            i += 1
+class Beatmap:
+    """
+    Карта с ленивым чтением: метаданные читаются сразу и только из заголовка файла,
+    объекты - при первом обращении к hitobjects (когда карту играют или показывают превью).
+    """
 
-        i = data.index("[HitObjects]\n") + 1
+    def __init__(self, file: str):
+        """
+        :param file: путь к файлу карты
+        """
+        self.file = file
+        self.metadata = get_metadata(file)
+        self._hitobjects = None
+
+    def is_mania(self) -> bool:
+        """
+        :return: True, если это osu!mania карта
+        """
+        return self.metadata.get('Mode') == '3'
+
+    @property
+    def hitobjects(self) -> np.ndarray:
+        """
+        Объекты карты (см. get_hitobjects), читаются при первом обращении
+        """
+        if self._hitobjects is None:
+            self._hitobjects = get_hitobjects(self.file)
+        return self._hitobjects
+
+
+def compile_beatmap(file: str) -> Tuple[dict, Dict[str, np.ndarray]]:
+    """
+    Читает карту в вид, готовый для игры и для хранения в кэше (см. utils.beatmap_cache)
 
-        hitobjects = np.array(list(map(lambda x: parse_hitobject(track_count, x), data[i:])), dtype=object)
+    :param file: путь к файлу карты
+    :return: metadata, arrays - словарик с метаданными (см. extract_metadata)
+    и словарик с массивами карты ('hitobjects' и таблица прокрутки 'scroll_times', 'scroll_positions',
+    'scroll_velocities', см. get_scroll_table)
+    """
+    sections = read_beatmap(file)
+    times, positions, velocities = get_scroll_table(sections['TimingPoints'])
 
-        return hitobjects
+    return extract_metadata(sections), {'hitobjects': sections['HitObjects'], 'scroll_times': times,
+                                        'scroll_positions': positions, 'scroll_velocities': velocities}
 
 
-def get_beatmaps(beatmaps_folder: str) -> list:
+def get_beatmap_set(map_directory: str) -> Union[dict, None]:
     """
+    Читает данные одной папки с картами (или архива .osz) для меню
 
-    :param beatmaps_folder: Папка с картами
-    :return: Список со словариками с данными всех карт для отрисовки меню
-    'beatmap_directory' - путь папки карты
+    :param map_directory: путь папки карты или архива .osz
+    :return: None, если в папке нет карт, иначе словарик
+    'beatmap_directory' - путь папки карты или архива .osz
     'artist' - Исполнитель песни
     'title' - название песни
     'music_path' - относительный путь до файла музыки
     'bg_image' - относительный путь до фонового изображения
-    'diffs' - список с словариками вида {название сложности: название файла карты}
     'preview' - милисекунды старта музыки для превью
+    'diffs' - список mania сложностей, словарики вида
+        'file' - название файла карты
+        'version' - название сложности
+        'mode' - режим игры
+        'circle_size' - количество дорожек
+        'od' - Overall Difficulty
+        'note_count' - количество объектов
+        'duration' - длина карты в мс
+        'stars' - численная сложность карты (см. utils.difficulty.get_star_rating)
     """
-    map_list = os.listdir(beatmaps_folder)
-    beatmaps_list = []
 
-    for map_ in map_list:
-        map_dict = dict()
+    beatmaps = sorted(i for i in list_files(map_directory) if i.endswith('.osu'))
 
-        map_directory = os.path.join(beatmaps_folder, map_)
-        map_dict["beatmap_directory"] = map_directory
+    if not beatmaps:
+        return None
+
+    map_dict = dict()
+    map_dict['beatmap_directory'] = map_directory
+    map_dict['diffs'] = []
+
+    for beatmap_file in beatmaps:
+        beatmap = Beatmap(os.path.join(map_directory, beatmap_file))
+        metadata = beatmap.metadata
+
+        if 'title' not in map_dict:
+            map_dict['artist'] = metadata['Artist']
+            map_dict['title'] = metadata['Title']
+            map_dict['preview'] = int(metadata['PreviewTime'])
 
-        beatmaps = [i for i in os.listdir(map_directory) if i.endswith('.osu')]
+            map_dict['music_path'] = os.path.join(map_directory, metadata['AudioFilename'])
+            map_dict['bg_image'] = os.path.join(map_directory, metadata['Background'])
 
-        if not beatmaps:
+        if not beatmap.is_mania():
             continue
 
-        metadata = get_metadata(os.path.join(map_directory, beatmaps[0]))
+        hitobjects = beatmap.hitobjects
+        map_dict['diffs'].append({
+            'file': beatmap_file,
+            'version': metadata['Version'],
+            'mode': int(metadata['Mode']),
+            'circle_size': int(metadata['CircleSize']),
+            'od': float(metadata['OverallDifficulty']),
+            'note_count': len(hitobjects),
+            'duration': get_map_duration(hitobjects) if len(hitobjects) else 0,
+            'stars': round(get_star_rating(hitobjects, int(metadata['CircleSize'])), 2),
+        })
 
-        map_dict['artist'] = metadata['Artist']
-        map_dict['title'] = metadata['Title']
-        map_dict['preview'] = metadata['PreviewTime']
+    return map_dict
 
-        map_dict['music_path'] = os.path.join(map_directory, metadata['AudioFilename'])
-        map_dict['bg_image'] = os.path.join(map_directory, metadata['Background'])
 
-        map_dict['diffs'] = []
+def get_beatmaps(beatmaps_folder: str) -> list:
+    """
+    Читает все папки с картами (без индекса библиотеки, см. utils.library)
 
-        for beatmap in beatmaps:
-            beatmap_path = os.path.join(map_directory, beatmap)
-            metadata = get_metadata(beatmap_path)
-            difficulty = metadata['Version']
-            if metadata['Mode'] == '3':
-                map_dict['diffs'].append({difficulty: beatmap})
+    :param beatmaps_folder: Папка с картами
+    :return: Список со словариками с данными всех карт для отрисовки меню (см. get_beatmap_set)
+    """
+    beatmaps_list = []
 
-        beatmaps_list.append(map_dict)
+    for map_ in sorted(os.listdir(beatmaps_folder)):
+        map_directory = os.path.join(beatmaps_folder, map_)
+        if not os.path.isdir(map_directory) and not is_archive(map_directory):
+            continue
+
+        map_dict = get_beatmap_set(map_directory)
+        if map_dict is not None:
+            beatmaps_list.append(map_dict)
 
     return beatmaps_list
 
 
-def get_map_duration(hitobjects: Union[np.array, list]) -> int:
+def split_columns(hitobjects: np.ndarray, track_count: int) -> List[np.ndarray]:
+    """
+    Разделяет объекты карты по дорожкам
+
+    :param hitobjects: np.array с объектами (HITOBJECT_DTYPE) в хронологическом порядке
+    :param track_count: количество дорожек
+    :return: список np.array объектов каждой дорожки (копии, в хронологическом порядке)
+    """
+    return [hitobjects[hitobjects['x'] == track_number] for track_number in range(track_count)]
+
+
+def get_map_duration(hitobjects: np.ndarray) -> int:
     """
     Возвращает длину карты в мс
-    :param hitobjects: np.array с объектами
+    :param hitobjects: np.array с объектами (HITOBJECT_DTYPE)
     :return: Длина карты в мс
     """
 
-    times = []
-    for hitobject in hitobjects:
-        if hitobject['type'] == 'note':
-            times.append(hitobject['time'])
-        else:
-            times.append(hitobject['endTime'])
-
-    return max(times)
+    return int(hitobjects['endTime'].max())
@@ -0,0 +1,80 @@
+import numpy as np
+
+# Окно, в котором считается плотность нот, мс
+DENSITY_WINDOW = 1000
+# Минимальный интервал между нотами одной дорожки (быстрее руками не нажать), мс
+MIN_JACK_INTERVAL = 40
+# Длина участка карты, по пикам которых считается итоговая сложность, мс
+SECTION_LENGTH = 400
+# Вес каждого следующего по сложности участка
+SECTION_DECAY = 0.9
+
+# Веса составляющих сложности ноты
+CHORD_WEIGHT = 0.5
+JACK_WEIGHT = 0.35
+HOLD_WEIGHT = 0.6
+
+# Множитель, переводящий сумму пиков в звёзды
+STAR_SCALE = 0.012
+
+
+def get_note_strains(hitobjects: np.ndarray, track_count: int) -> np.ndarray:
+    """
+    Считает сложность каждого объекта карты.
+    Сложность ноты - общая плотность нот (нот в секунду за последнее окно DENSITY_WINDOW),
+    увеличенная за аккорды и зажатые в этот момент холды, плюс скорость джека на её дорожке
+    (нот в секунду по интервалу до предыдущей ноты той же дорожки).
+
+    :param hitobjects: np.array с объектами (HITOBJECT_DTYPE) в хронологическом порядке
+    :param track_count: количество дорожек
+    :return: np.array сложностей объектов
+    """
+    times = hitobjects['time'].astype(np.int64)
+    columns = hitobjects['x'].astype(np.int64)
+
+    # Плотность: сколько нот за последнее окно, включая эту
+    density = (np.arange(len(times)) + 1 - np.searchsorted(times, times - DENSITY_WINDOW, side='right')) \
+        * (1000 / DENSITY_WINDOW)
+
+    # Аккорды: сколько нот начинается одновременно с этой
+    _, chord_index, chord_counts = np.unique(times, return_inverse=True, return_counts=True)
+    chord = (chord_counts[chord_index] - 1) / max(track_count - 1, 1)
+
+    # Джеки: интервал до предыдущей ноты той же дорожки
+    order = np.lexsort((times, columns))
+    intervals = np.full(len(times), np.inf)
+    same_column = columns[order][1:] == columns[order][:-1]
+    intervals[order[1:][same_column]] = np.diff(times[order])[same_column]
+    jack = 1000 / np.maximum(intervals, MIN_JACK_INTERVAL)
+
+    # Холды: сколько холдов зажато в момент нажатия ноты
+    # (у нот endTime совпадает с time, так что они ничего не добавляют)
+    hold_overlap = np.searchsorted(times, times, side='left') - \
+        np.searchsorted(np.sort(hitobjects['endTime']), times, side='left')
+    hold_overlap = np.maximum(hold_overlap, 0) / max(track_count - 1, 1)
+
+    return density * (1 + CHORD_WEIGHT * chord + HOLD_WEIGHT * hold_overlap) + JACK_WEIGHT * jack
+
+
+def get_star_rating(hitobjects: np.ndarray, track_count: int) -> float:
+    """
+    Считает численную сложность карты (звёзды).
+    Карта делится на участки по SECTION_LENGTH мс, у каждого берётся самая сложная нота,
+    пики сортируются по убыванию и складываются с весами SECTION_DECAY ** i,
+    так что длинная карта не становится сложнее только за счёт длины.
+
+    :param hitobjects: np.array с объектами (HITOBJECT_DTYPE)
+    :param track_count: количество дорожек
+    :return: сложность карты, 0 для пустой карты
+    """
+    if not len(hitobjects) or track_count <= 0:
+        return 0.
+
+    hitobjects = hitobjects[np.argsort(hitobjects['time'], kind='stable')]
+    strains = get_note_strains(hitobjects, track_count)
+
+    sections = (hitobjects['time'] - hitobjects['time'][0]) // SECTION_LENGTH
+    section_starts = np.flatnonzero(np.r_[True, sections[1:] != sections[:-1]])
+    peaks = np.sort(np.maximum.reduceat(strains, section_starts))[::-1]
+
+    return float(STAR_SCALE * np.sum(peaks * SECTION_DECAY ** np.arange(len(peaks))))
@@ -0,0 +1,158 @@
+import time
+import logging
+from typing import Tuple, Dict, List
+
+import numpy as np
+import pygame as pg
+
+logger = logging.getLogger(__name__)
+
+# Режимы ритма кадров:
+# 'event' - кадр только после событий (для меню, где без событий ничего не меняется),
+# 'sleep' - не чаще fps, ожидание через time.sleep (меньше всего нагружает процессор, точность ожидания 1-2 мс),
+# 'precise' - не чаще fps, последние SPIN_MARGIN мс до кадра ожидание в цикле (как Clock.tick_busy_loop),
+# 'display' - по частоте обновления экрана (вертикальная синхронизация, см. set_display_mode), fps - верхний предел.
+#             Показ кадра блокируется до обновления экрана, и нажатия за это время получают время после показа,
+#             так что оценка нажатий в этом режиме хуже (до одного обновления экрана, 16.7 мс при 60 Гц),
+# 'uncapped' - кадры без ожидания
+PACING_MODES = ('event', 'sleep', 'precise', 'display', 'uncapped')
+GAME_PACING_MODES = ('sleep', 'precise', 'display', 'uncapped')
+# За сколько мс до кадра режим precise перестаёт спать и ждёт в цикле
+SPIN_MARGIN = 2.
+# Как долго режим event ждёт события, прежде чем вернуть пустой список (чтобы меню могло обновить библиотеку), мс
+EVENT_TIMEOUT = 100
+# По скольким последним кадрам считается разброс
+JITTER_WINDOW = 1000
+
+
+def set_display_mode(size: Tuple[int, int], vsync: bool = False) -> pg.Surface:
+    """
+    Создаёт окно игры. Вертикальную синхронизацию pygame включает только для окон с флагом SCALED,
+    и её может не быть вовсе - тогда окно создаётся без неё, а режим 'display' ограничен только fps.
+    С ней pg.display.update ждёт обновления экрана, и события за это время забираются только после показа
+    (см. Game.draw_frame, который забирает их непосредственно перед показом).
+
+    :param size: размер окна
+    :param vsync: включить вертикальную синхронизацию (нужна режиму 'display')
+    :return: поверхность окна
+    """
+    if vsync:
+        try:
+            return pg.display.set_mode(size, pg.SCALED, vsync=1)
+        except pg.error as e:
+            logger.warning('Vertical sync is not available (%s), frames are capped by FPS only', e)
+    return pg.display.set_mode(size)
+
+
+class FramePacer:
+    """
+    Ритм кадров игрового цикла или меню (см. PACING_MODES) и замер того, насколько ровно идут кадры.
+    Цикл спрашивает frame_due, рисует кадр, сообщает о нём frame_drawn и ждёт в wait.
+    """
+
+    def __init__(self, mode: str, fps: float):
+        """
+        :param mode: режим из PACING_MODES
+        :param fps: частота кадров (для 'display' - верхний предел)
+        """
+        if mode not in PACING_MODES:
+            raise ValueError(f'Unknown frame pacing mode: {mode}')
+
+        self.mode = mode
+        self.fps = fps
+        self.interval = 1000 / fps
+        self.next_frame = time.perf_counter() * 1000
+
+        # Интервалы между последними кадрами в мс (кольцевой буфер)
+        self.intervals = np.zeros(JITTER_WINDOW)
+        self.position = 0
+        self.count = 0
+        self.last_frame = None
+
+    def start(self) -> None:
+        """
+        Начинает отсчёт кадров заново: следующий кадр нужен сразу
+
+        :return: None
+        """
+        self.next_frame = time.perf_counter() * 1000
+        self.last_frame = None
+
+    def frame_due(self) -> bool:
+        """
+        :return: True, если пора рисовать кадр
+        """
+        return self.mode == 'uncapped' or time.perf_counter() * 1000 >= self.next_frame
+
+    def frame_drawn(self) -> None:
+        """
+        Отмечает, что кадр нарисован и показан, и назначает время следующего
+
+        :return: None
+        """
+        now = time.perf_counter() * 1000
+        if self.last_frame is not None:
+            self.intervals[self.position] = now - self.last_frame
+            self.position = (self.position + 1) % JITTER_WINDOW
+            self.count = min(self.count + 1, JITTER_WINDOW)
+        self.last_frame = now
+
+        self.next_frame += self.interval
+        if self.next_frame < now:
+            # Кадр опоздал больше чем на интервал, пропущенные кадры не нагоняем
+            self.next_frame = now + self.interval
+
+    def wait(self, deadline: float = float('inf')) -> None:
+        """
+        Ждёт следующего кадра или deadline, смотря что раньше
+
+        :param deadline: время по time.perf_counter в мс (например, следующий шаг ввода)
+        :return: None
+        """
+        if self.mode in ('event', 'uncapped'):
+            return
+
+        target = min(deadline, self.next_frame)
+        if self.mode == 'precise' and self.next_frame <= deadline:
+            time.sleep(max(0., target - SPIN_MARGIN - time.perf_counter() * 1000) / 1000)
+            while time.perf_counter() * 1000 < target:
+                pass
+        else:
+            time.sleep(max(0., target - time.perf_counter() * 1000) / 1000)
+
+    def get_events(self) -> List[pg.event.Event]:
+        """
+        Для меню: ждёт событий (режим 'event') или следующего кадра и забирает события из очереди
+
+        :return: список событий (в режиме 'event' пустой, если за EVENT_TIMEOUT событий не было)
+        """
+        if self.mode == 'event':
+            event = pg.event.wait(EVENT_TIMEOUT)
+            return ([event] if event.type != pg.NOEVENT else []) + pg.event.get()
+
+        self.wait()
+        return pg.event.get()
+
+    def get_jitter(self) -> Dict[str, float]:
+        """
+        :return: словарик по последним кадрам: 'fps', средний интервал между кадрами 'interval_ms',
+        его стандартное отклонение 'jitter_ms' и p99 отклонения интервала от целевого 'p99_ms'
+        (целевой - 1000 / fps для 'sleep' и 'precise', средний интервал для остальных режимов)
+        """
+        if not self.count:
+            return {'fps': 0., 'interval_ms': 0., 'jitter_ms': 0., 'p99_ms': 0.}
+
+        intervals = self.intervals[:self.count]
+        mean = float(intervals.mean())
+        target = self.interval if self.mode in ('sleep', 'precise') else mean
+
+        return {'fps': 1000 / mean if mean else 0., 'interval_ms': mean, 'jitter_ms': float(intervals.std()),
+                'p99_ms': float(np.percentile(np.abs(intervals - target), 99))}
+
+    def get_report(self) -> str:
+        """
+        :return: строка с режимом и разбросом кадров (см. get_jitter)
+        """
+        jitter = self.get_jitter()
+        return f"{self.mode} {jitter['fps']:.0f} fps, jitter {jitter['jitter_ms']:.2f} ms " \
+               f"(p99 {jitter['p99_ms']:.2f} ms)"
@@ -0,0 +1,117 @@
+import time
+from typing import Union
+
+# Как часто время игры сверяется со звуком, мс
+AUDIO_SYNC_INTERVAL = 100
+# Доля расхождения со звуком, на которую поправляется время при каждой сверке
+SYNC_SMOOTHING = 0.1
+# Расхождения больше этого считаются ошибкой измерения (например, звук ещё не начался), мс
+MAX_AUDIO_OFFSET = 1000
+
+
+def get_playback_position(player) -> Union[float, None]:
+    """
+    Возвращает, сколько мс песни уже проиграно. У audioplayer нет такого метода,
+    поэтому положение спрашивается у плеера, который он использует на данной системе
+    (GStreamer на Linux, MCI на Windows, NSSound на macOS).
+
+    :param player: audioplayer.AudioPlayer
+    :return: положение в мс или None, если его не удалось узнать
+    """
+    backend = getattr(player, '_player', None)
+    if backend is None:
+        return None
+
+    try:
+        if hasattr(backend, 'query_position'):
+            from gi.repository import Gst
+            ok, position = backend.query_position(Gst.Format.TIME)
+            return position / 10 ** 6 if ok else None
+
+        if hasattr(backend, 'currentTime'):
+            return backend.currentTime() * 1000
+
+        if hasattr(player, '_alias'):
+            from ctypes import windll, create_unicode_buffer
+            buffer = create_unicode_buffer(32)
+            if windll.winmm.mciSendStringW(f'status {player._alias} position', buffer, len(buffer), 0):
+                return None
+            return float(buffer.value)
+    except Exception:
+        return None
+
+    return None
+
+
+class GameClock:
+    """
+    Часы карты. Время идёт по time.perf_counter (точно и монотонно), а во время игры песни
+    понемногу подстраивается под положение звука (см. sync), так что задержка запуска звука и
+    расхождение часов звуковой карты не сдвигают оценку нажатий.
+    """
+
+    def __init__(self, lead_in: float = 0.):
+        """
+        :param lead_in: сколько мс до начала песни (время карты начинается с -lead_in)
+        """
+        self.lead_in = lead_in
+        self.start_time = time.perf_counter()
+
+        # Насколько звук впереди часов perf_counter (сглаженное), мс
+        self.offset = 0.
+        self.synced = False
+        self.last_sync = -float('inf')
+
+    def start(self, lead_in: float = None) -> None:
+        """
+        Запускает часы с -lead_in
+
+        :param lead_in: сколько мс до начала песни (None - оставить прежнее значение)
+        :return: None
+        """
+        if lead_in is not None:
+            self.lead_in = lead_in
+        self.start_time = time.perf_counter()
+
+    def get_raw_time(self) -> float:
+        """
+        :return: время карты в мс по perf_counter, без поправки по звуку
+        """
+        return (time.perf_counter() - self.start_time) * 1000 - self.lead_in
+
+    def get_time(self) -> float:
+        """
+        :return: время карты в мс
+        """
+        return self.get_raw_time() + self.offset
+
+    def sync(self, audio_position: Union[float, None]) -> None:
+        """
+        Поправляет время по положению звука. Первое измерение принимается сразу (задержка запуска звука),
+        следующие - с коэффициентом SYNC_SMOOTHING, чтобы неточность измерений не дёргала ноты.
+
+        :param audio_position: положение звука в мс (см. get_playback_position) или None
+        :return: None
+        """
+        raw_time = self.get_raw_time()
+        self.last_sync = raw_time
+
+        # До начала песни (и сразу после, пока плеер не начал отдавать положение) сверять не с чем
+        if audio_position is None or audio_position <= 0 or raw_time <= 0:
+            return
+
+        measured = audio_position - raw_time
+        if abs(measured) > MAX_AUDIO_OFFSET:
+            return
+
+        if self.synced:
+            self.offset += SYNC_SMOOTHING * (measured - self.offset)
+        else:
+            self.offset = measured
+            self.synced = True
+
+    def need_sync(self) -> bool:
+        """
+        :return: True, если с прошлой сверки со звуком прошло AUDIO_SYNC_INTERVAL мс
+        """
+        return self.get_raw_time() - self.last_sync >= AUDIO_SYNC_INTERVAL
@@ -0,0 +1,108 @@
+import math
+from typing import Tuple
+
+import numpy as np
+
+# Запись об оценённом нажатии: время карты в мс, смещение (время нажатия - время объекта) в мс и номер дорожки
+HIT_ERROR_DTYPE = np.dtype([
+    ('time', np.float64),
+    ('offset', np.float32),
+    ('column', np.int8),
+])
+
+
+class HitErrors:
+    """
+    Смещения всех оценённых (не пропущенных) нажатий и отпусканий концов холдов за игру.
+    Записи хранятся в заранее выделенном буфере, который удваивается, если его не хватило.
+    Среднее и дисперсия смещений считаются при добавлении (алгоритм Уэлфорда), так что
+    unstable rate доступен за O(1) в любой момент игры.
+    """
+
+    def __init__(self, capacity: int = 4096):
+        """
+        :param capacity: на сколько записей выделить буфер
+        """
+        self.buffer = np.zeros(max(capacity, 1), dtype=HIT_ERROR_DTYPE)
+        self.count = 0
+
+        self.mean = 0.
+        self.m2 = 0.
+
+    def add(self, column: int, map_time: float, offset: float) -> None:
+        """
+        Записывает смещение нажатия
+
+        :param column: номер дорожки
+        :param map_time: время нажатия по времени карты в мс
+        :param offset: время нажатия - время объекта в мс (отрицательное - раньше)
+        :return: None
+        """
+        offset = float(offset)
+        if self.count == len(self.buffer):
+            self.buffer = np.concatenate((self.buffer, np.zeros_like(self.buffer)))
+
+        self.buffer[self.count] = (map_time, offset, column)
+        self.count += 1
+
+        delta = offset - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (offset - self.mean)
+
+    def get_entries(self) -> np.ndarray:
+        """
+        :return: np.array записанных нажатий (HIT_ERROR_DTYPE) по порядку, без копирования
+        """
+        return self.buffer[:self.count]
+
+    def get_recent(self, count: int) -> np.ndarray:
+        """
+        :param count: сколько последних нажатий вернуть
+        :return: np.array смещений последних нажатий, от старых к новым
+        """
+        return self.buffer['offset'][max(self.count - count, 0):self.count]
+
+    def get_mean(self) -> float:
+        """
+        :return: среднее смещение в мс (положительное - нажатия в среднем поздние)
+        """
+        return self.mean
+
+    def get_unstable_rate(self) -> float:
+        """
+        :return: unstable rate - стандартное отклонение смещений в мс, умноженное на 10
+        """
+        return 10 * math.sqrt(self.m2 / self.count) if self.count else 0.
+
+    def get_histograms(self, track_count: int, bin_ms: float, max_offset: float) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Считает гистограммы смещений для каждой дорожки сразу. Смещения за пределами
+        [-max_offset, max_offset] попадают в крайние корзины.
+
+        :param track_count: количество дорожек
+        :param bin_ms: ширина корзины в мс
+        :param max_offset: граница гистограммы в мс
+        :return: границы корзин (bins + 1) и количество нажатий (track_count, bins)
+        """
+        bins = max(int(math.ceil(2 * max_offset / bin_ms)), 1)
+        edges = -max_offset + np.arange(bins + 1) * bin_ms
+
+        entries = self.get_entries()
+        entries = entries[entries['column'] < track_count]
+        indices = np.clip(np.floor((entries['offset'] + max_offset) / bin_ms).astype(np.int64), 0, bins - 1)
+        counts = np.bincount(entries['column'].astype(np.int64) * bins + indices, minlength=track_count * bins)
+
+        return edges, counts.reshape(track_count, bins)
+
+    def get_column_means(self, track_count: int) -> np.ndarray:
+        """
+        :param track_count: количество дорожек
+        :return: np.array среднего смещения каждой дорожки в мс (0, если нажатий не было)
+        """
+        entries = self.get_entries()
+        entries = entries[entries['column'] < track_count]
+        columns = entries['column'].astype(np.int64)
+
+        sums = np.bincount(columns, weights=entries['offset'], minlength=track_count)
+        counts = np.bincount(columns, minlength=track_count)
+        return np.divide(sums, counts, out=np.zeros(track_count), where=counts > 0)
@@ -0,0 +1,219 @@
+from typing import Tuple, Union, Sequence
+
+import numpy as np
+import pygame as pg
+
+from utils.hit_errors import HitErrors
+
+# Сколько последних нажатий показывает полоса отклонений
+RECENT_HITS = 30
+# Цвета зон окон 300, 100 и 50 на полосе отклонений
+HIT_WINDOW_COLORS = ((50, 180, 255), (90, 220, 90), (230, 180, 60))
+
+
+class GlyphCache:
+    """
+    Кэш отрисованных символов шрифта. Каждый символ растеризуется один раз,
+    строки (числа, проценты) собираются из готовых символов.
+    Рассчитан на моноширинные шрифты (кернинг не учитывается).
+    """
+
+    def __init__(self, font: pg.font.Font, color: Union[int, Tuple[int, int, int]]):
+        """
+        :param font: шрифт
+        :param color: цвет текста
+        """
+        self.font = font
+        self.color = color
+        self.height = font.get_height()
+        self.glyphs = dict()
+
+    def get_glyph(self, char: str) -> pg.Surface:
+        """
+        :param char: символ
+        :return: поверхность с символом
+        """
+        glyph = self.glyphs.get(char)
+        if glyph is None:
+            glyph = self.font.render(char, True, self.color).convert_alpha()
+            self.glyphs[char] = glyph
+        return glyph
+
+    def size(self, text: str) -> Tuple[int, int]:
+        """
+        :param text: строка
+        :return: ширина и высота строки
+        """
+        return sum(self.get_glyph(char).get_width() for char in text), self.height
+
+
+class HudText:
+    """
+    Текст поверх фона игры (очки, точность, комбо). Перерисовывается только когда меняется строка:
+    фон под старой и новой строкой восстанавливается, и новая строка собирается из символов GlyphCache.
+    Если строка заходит на то, что рисуется каждый кадр (дорожки), её часть там рисуется заново (см. draw_over).
+    """
+
+    def __init__(self, glyphs: GlyphCache, position: Tuple[int, int], anchor: str = 'topleft'):
+        """
+        :param glyphs: кэш символов шрифта
+        :param position: координаты точки привязки
+        :param anchor: какой угол строки привязан к position (атрибут pg.Rect, например 'topright')
+        """
+        self.glyphs = glyphs
+        self.position = position
+        self.anchor = anchor
+
+        self.text = None
+        self.rect = None
+
+    def draw(self, surface: pg.Surface, background: pg.Surface, text: str) -> Union[pg.Rect, None]:
+        """
+        Рисует строку, если она изменилась
+
+        :param surface: поверхность, на которую рисуется текст
+        :param background: фон surface, которым стирается старая строка
+        :param text: строка
+        :return: изменённая область surface или None, если строка не изменилась
+        """
+        if text == self.text:
+            return None
+
+        rect = pg.Rect((0, 0), self.glyphs.size(text))
+        setattr(rect, self.anchor, self.position)
+        dirty_rect = rect if self.rect is None else rect.union(self.rect)
+
+        surface.blit(background, dirty_rect, dirty_rect)
+
+        self.text = text
+        self.rect = rect
+        self.__paint(surface)
+        return dirty_rect
+
+    def draw_over(self, surface: pg.Surface, rects: Sequence[pg.Rect]) -> None:
+        """
+        Рисует строку заново (без фона) там, где она пересекается с rects.
+        Нужно, если в rects в этом кадре уже нарисовано что-то поверх строки (например, дорожки)
+
+        :param surface: поверхность, на которую рисуется текст
+        :param rects: области surface, нарисованные заново
+        :return: None
+        """
+        if not self.text:
+            return
+
+        clip = surface.get_clip()
+        for index in self.rect.collidelistall(rects):
+            surface.set_clip(self.rect.clip(rects[index]))
+            self.__paint(surface)
+        surface.set_clip(clip)
+
+    def __paint(self, surface: pg.Surface) -> None:
+        """
+        Собирает строку self.text из символов в self.rect
+
+        :param surface: поверхность, на которую рисуется текст
+        :return: None
+        """
+        sprites = []
+        x = self.rect.x
+        for char in self.text:
+            glyph = self.glyphs.get_glyph(char)
+            sprites.append((glyph, (x, self.rect.y)))
+            x += glyph.get_width()
+        surface.blits(sprites, doreturn=False)
+
+
+class HitErrorBar:
+    """
+    Полоса отклонений нажатий: зоны окон 300, 100 и 50 и риски последних RECENT_HITS нажатий
+    (левее центра - раньше, правее - позже, новые ярче старых) и среднее смещение за игру.
+    Перерисовывается только после новых нажатий (и поверх дорожек, см. draw_over).
+    """
+
+    def __init__(self, hit_windows: Tuple[float, float, float], position: Tuple[int, int],
+                 width: int = 240, height: int = 24):
+        """
+        :param hit_windows: рамки очков window_300, window_100, window_50 в мс (см. get_hit_windows)
+        :param position: координаты середины нижнего края полосы
+        :param width: ширина полосы
+        :param height: высота полосы
+        """
+        self.max_offset = hit_windows[2]
+        self.scale = width / 2 / self.max_offset
+
+        self.rect = pg.Rect(0, 0, width, height)
+        self.rect.midbottom = position
+
+        # Зоны окон рисуются один раз, от широкой (50) к узкой (300)
+        self.base = pg.Surface((width, height), pg.SRCALPHA).convert_alpha()
+        zone_height = height // 3
+        for window, color in reversed(list(zip(hit_windows, HIT_WINDOW_COLORS))):
+            zone_width = round(2 * window * self.scale)
+            pg.draw.rect(self.base, color, ((width - zone_width) // 2, zone_height, zone_width, zone_height))
+
+        self.drawn_count = None
+        # Координаты x рисок последних нажатий и среднего смещения (None - нажатий не было)
+        self.xs = []
+        self.mean_x = None
+
+    def draw(self, surface: pg.Surface, background: pg.Surface, hit_errors: HitErrors) -> Union[pg.Rect, None]:
+        """
+        Рисует полосу, если с прошлого раза были новые нажатия
+
+        :param surface: поверхность, на которую рисуется полоса
+        :param background: фон surface, которым стирается старая полоса
+        :param hit_errors: смещения нажатий
+        :return: изменённая область surface или None, если нажатий не было
+        """
+        if hit_errors.count == self.drawn_count:
+            return None
+
+        offsets = np.clip(hit_errors.get_recent(RECENT_HITS), -self.max_offset, self.max_offset)
+        self.xs = np.rint(self.rect.centerx + offsets * self.scale).astype(int).tolist()
+        self.mean_x = None
+        if hit_errors.count:
+            mean = min(max(hit_errors.get_mean(), -self.max_offset), self.max_offset)
+            self.mean_x = round(self.rect.centerx + mean * self.scale)
+
+        surface.blit(background, self.rect, self.rect)
+        self.__paint(surface)
+
+        self.drawn_count = hit_errors.count
+        return self.rect
+
+    def draw_over(self, surface: pg.Surface, rects: Sequence[pg.Rect]) -> None:
+        """
+        Рисует полосу заново (без фона) там, где она пересекается с rects (см. HudText.draw_over)
+
+        :param surface: поверхность, на которую рисуется полоса
+        :param rects: области surface, нарисованные заново
+        :return: None
+        """
+        if self.drawn_count is None:
+            return
+
+        clip = surface.get_clip()
+        for index in self.rect.collidelistall(rects):
+            surface.set_clip(self.rect.clip(rects[index]))
+            self.__paint(surface)
+        surface.set_clip(clip)
+
+    def __paint(self, surface: pg.Surface) -> None:
+        """
+        Рисует зоны окон, риски нажатий и среднее смещение по последнему draw
+
+        :param surface: поверхность, на которую рисуется полоса
+        :return: None
+        """
+        surface.blit(self.base, self.rect)
+
+        for i, x in enumerate(self.xs):
+            brightness = 60 + 195 * (i + 1 + RECENT_HITS - len(self.xs)) // RECENT_HITS
+            pg.draw.line(surface, (brightness, brightness, brightness), (x, self.rect.top + 2),
+                         (x, self.rect.bottom - 3), 2)
+
+        if self.mean_x is not None:
+            x = self.mean_x
+            pg.draw.polygon(surface, (255, 230, 0), ((x - 5, self.rect.top), (x + 5, self.rect.top),
+                                                     (x, self.rect.top + 6)))
@@ -0,0 +1,315 @@
+import os
+import sys
+import json
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Tuple, Union
+
+from utils.beatmap_utils import get_beatmap_set
+from utils.archive import is_archive
+
+# Меняется при изменении формата индекса, старый индекс при этом строится заново
+INDEX_VERSION = 3
+# Сколько раз за сканирование пул процессов перезапускается, если процесс пула умер (например, из-за нехватки памяти)
+MAX_POOL_RESTARTS = 2
+# Как часто во время сканирования прочитанные папки сохраняются в индекс, с
+INDEX_SAVE_INTERVAL = 5.
+
+
+def get_folder_signature(map_directory: str) -> dict:
+    """
+    Возвращает отпечаток папки карты, по которому определяется, нужно ли её перечитывать
+
+    :param map_directory: путь папки карты или архива .osz
+    :return: словарик с mtime папки и {имя .osu файла: [mtime, размер]} (для архива - mtime и размер архива)
+    """
+    if is_archive(map_directory):
+        stat = os.stat(map_directory)
+        return {'mtime': stat.st_mtime_ns, 'size': stat.st_size}
+
+    files = dict()
+
+    with os.scandir(map_directory) as it:
+        for entry in it:
+            if entry.name.endswith('.osu'):
+                stat = entry.stat()
+                files[entry.name] = [stat.st_mtime_ns, stat.st_size]
+
+    return {'mtime': os.stat(map_directory).st_mtime_ns, 'files': files}
+
+
+def scan_folder(map_directory: str) -> Tuple[Union[dict, None], Union[str, None]]:
+    """
+    Читает одну папку с картами. Выполняется в процессах пула, поэтому ошибка в одной папке
+    не прерывает сканирование остальных.
+
+    :param map_directory: путь папки карты
+    :return: данные карты (см. get_beatmap_set) и None, либо None и текст ошибки
+    """
+    try:
+        return get_beatmap_set(map_directory), None
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}'
+
+
+class BeatmapLibrary:
+    """
+    Индекс библиотеки карт, сохраняемый между запусками.
+
+    Для каждой папки хранится её отпечаток (см. get_folder_signature) и данные для меню (см. get_beatmap_set).
+    При сканировании заново читаются только новые папки и папки, отпечаток которых изменился,
+    параллельно в пуле процессов; готовые папки можно забирать по мере готовности (см. poll).
+    """
+
+    def __init__(self, beatmaps_folder: str, index_file: str):
+        """
+        :param beatmaps_folder: Папка с картами
+        :param index_file: путь к файлу индекса
+        """
+        self.beatmaps_folder = beatmaps_folder
+        self.index_file = index_file
+
+        self.folders = self.load_index()
+        self.changed = False
+        self.saved_at = time.monotonic()
+
+        self.executor = None
+        self.workers = None
+        self.restarts = 0
+        self.pending = dict()
+        self.finished = []
+
+    def load_index(self) -> dict:
+        """
+        Читает индекс с диска
+
+        :return: словарик {имя папки: {'signature': отпечаток, 'set': данные карты или None, 'error': ошибка или None}}
+        """
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+        if index.get('version') != INDEX_VERSION or index.get('beatmaps_folder') != self.beatmaps_folder:
+            return dict()
+
+        return index['folders']
+
+    def save_index(self) -> None:
+        """
+        Сохраняет индекс на диск. Папки, которые ещё сканируются, в индексе отсутствуют
+        и будут прочитаны заново, если сканирование прервётся.
+
+        :return: None
+        """
+        index = {'version': INDEX_VERSION, 'beatmaps_folder': self.beatmaps_folder, 'folders': self.folders}
+
+        tmp_path = self.index_file + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(tmp_path, self.index_file)
+
+        self.changed = False
+        self.saved_at = time.monotonic()
+
+    def save_changes(self) -> None:
+        """
+        Сохраняет индекс на диск, если он изменился с прошлого сохранения
+
+        :return: None
+        """
+        if self.changed:
+            self.save_index()
+
+    def list_folders(self) -> list:
+        """
+        Возвращает имена всех папок с картами (и архивов .osz) и убирает из индекса удалённые
+
+        :return: отсортированный список имён папок
+        """
+        names = sorted(name for name in os.listdir(self.beatmaps_folder)
+                       if os.path.isdir(os.path.join(self.beatmaps_folder, name)) or
+                       is_archive(os.path.join(self.beatmaps_folder, name)))
+
+        for name in set(self.folders) - set(names):
+            del self.folders[name]
+            self.changed = True
+
+        return names
+
+    def start_scan(self, workers: Union[int, None] = None) -> None:
+        """
+        Начинает обновление индекса: папки, которые изменились с прошлого сканирования,
+        отправляются на чтение в пул процессов. Результаты забираются через poll.
+
+        :param workers: количество процессов (None - по количеству ядер)
+        :return: None
+        """
+        stale = []
+        for name in self.list_folders():
+            signature = get_folder_signature(os.path.join(self.beatmaps_folder, name))
+            record = self.folders.get(name)
+            if record is None or record['signature'] != signature:
+                # Устаревшая запись не должна попасть в меню, новая придёт через poll
+                self.folders.pop(name, None)
+                stale.append((name, signature))
+
+        if len(stale) < 2:
+            # Ради одной папки не стоит поднимать процессы. Папка сразу попадает в индекс и видна через
+            # get_beatmaps, поэтому в finished она не добавляется (иначе poll вернул бы её второй раз)
+            for name, signature in stale:
+                self.add_record(name, signature, *scan_folder(os.path.join(self.beatmaps_folder, name)))
+            return
+
+        self.workers = workers
+        self.restarts = 0
+        self.submit(stale)
+
+    def submit(self, folders: list) -> None:
+        """
+        Отправляет папки на чтение в пул процессов (создаёт пул, если его нет)
+
+        :param folders: список (имя папки, отпечаток папки)
+        :return: None
+        """
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                mp_context=multiprocessing.get_context('spawn'))
+        for name, signature in folders:
+            future = self.executor.submit(scan_folder, os.path.join(self.beatmaps_folder, name))
+            self.pending[future] = (name, signature)
+
+    def poll(self) -> list:
+        """
+        Забирает готовые результаты сканирования, не блокируя. Прочитанные папки сохраняются в индекс
+        раз в INDEX_SAVE_INTERVAL секунд, когда всё готово - сразу, и пул процессов закрывается.
+
+        :return: Список данных карт (см. get_beatmap_set), прочитанных с прошлого вызова
+        """
+        broken = False
+        for future in [future for future in self.pending if future.done()]:
+            name, signature = self.pending.pop(future)
+            try:
+                self.add_record(name, signature, *future.result())
+            except BrokenProcessPool:
+                broken = True
+                self.pending[future] = (name, signature)
+                continue
+            except Exception as e:
+                # Запись без отпечатка: папка будет прочитана заново при следующем сканировании
+                self.add_record(name, None, None, f'{type(e).__name__}: {e}')
+            self.finished.append(name)
+
+        if broken:
+            self.restart_pool()
+
+        new_sets = [self.folders[name]['set'] for name in self.finished if self.folders[name]['set'] is not None]
+        self.finished = []
+
+        if not self.pending:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+            self.save_changes()
+        elif time.monotonic() - self.saved_at >= INDEX_SAVE_INTERVAL:
+            self.save_changes()
+
+        return new_sets
+
+    def close(self) -> None:
+        """
+        Прерывает сканирование (например, при выходе из игры), не дожидаясь непрочитанных папок:
+        их задачи отменяются, и папки будут прочитаны при следующем сканировании.
+        Уже прочитанные папки сохраняются в индекс.
+
+        :return: None
+        """
+        for future in [future for future in self.pending if future.done()]:
+            name, signature = self.pending.pop(future)
+            try:
+                self.add_record(name, signature, *future.result())
+            except Exception:
+                # Задача не выполнилась (например, умер процесс пула): папки нет в индексе,
+                # она будет прочитана при следующем сканировании
+                continue
+
+        self.pending = dict()
+        self.finished = []
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        self.save_changes()
+
+    def restart_pool(self) -> None:
+        """
+        Процесс пула умер, и все папки, которые ещё не прочитаны, завершились с ошибкой BrokenProcessPool.
+        Пул закрывается, и эти папки отправляются в новый пул. Какая папка убила процесс, узнать нельзя,
+        поэтому после MAX_POOL_RESTARTS перезапусков оставшиеся папки записываются как ошибки
+        (без отпечатка, чтобы при следующем сканировании их прочитать заново).
+
+        :return: None
+        """
+        folders = list(self.pending.values())
+        self.pending = dict()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = None
+
+        if self.restarts >= MAX_POOL_RESTARTS:
+            for name, signature in folders:
+                self.add_record(name, None, None, 'BrokenProcessPool: a worker process terminated abruptly')
+                self.finished.append(name)
+            return
+
+        self.restarts += 1
+        self.submit(folders)
+
+    def is_scanning(self) -> bool:
+        """
+        :return: True, если сканирование ещё не закончено
+        """
+        return bool(self.pending)
+
+    def add_record(self, name: str, signature: Union[dict, None], beatmap_set: Union[dict, None],
+                   error: Union[str, None]) -> None:
+        """
+        Записывает результат чтения папки в индекс.
+        Папка с ошибкой тоже запоминается, чтобы не перечитывать её, пока она не изменится.
+
+        :param name: имя папки карты
+        :param signature: отпечаток папки (None - прочитать папку заново при следующем сканировании)
+        :param beatmap_set: данные карты или None
+        :param error: текст ошибки или None
+        :return: None
+        """
+        if error is not None:
+            print(f'Failed to read beatmap folder {name}: {error}', file=sys.stderr)
+
+        self.folders[name] = {'signature': signature, 'set': beatmap_set, 'error': error}
+        self.changed = True
+
+    def scan(self, workers: Union[int, None] = None) -> list:
+        """
+        Обновляет индекс по содержимому папки с картами, дожидаясь окончания сканирования
+
+        :param workers: количество процессов (None - по количеству ядер)
+        :return: Список со словариками с данными всех карт для отрисовки меню (см. get_beatmap_set)
+        """
+        self.start_scan(workers)
+        self.poll()
+        while self.pending:
+            # После перезапуска пула (см. restart_pool) в pending появляются новые задачи
+            wait(list(self.pending))
+            self.poll()
+
+        return self.get_beatmaps()
+
+    def get_beatmaps(self) -> list:
+        """
+        Возвращает данные всех уже прочитанных карт из индекса
+
+        :return: Список со словариками с данными всех карт (см. get_beatmap_set)
+        """
+        return [self.folders[name]['set'] for name in sorted(self.folders) if self.folders[name]['set'] is not None]
@@ -0,0 +1,113 @@
+import os
+import sys
+import json
+import time
+import platform
+from typing import Sequence, Dict, Tuple
+
+import numpy as np
+import pygame as pg
+
+# Сколько последних кадров хранится для среднего и p99
+RING_SIZE = 1000
+# Гистограммы времени кадра за всю карту: ширина корзины и количество корзин (последняя - всё, что дольше)
+HISTOGRAM_BIN_MS = 0.25
+HISTOGRAM_BINS = 400
+
+
+class FrameProfiler:
+    """
+    Замер времени этапов игрового цикла.
+
+    Время между вызовами lap записывается в этап, названный в lap, и копится до end_frame:
+    так в кадр попадает и работа шагов ввода между кадрами. Последние RING_SIZE кадров хранятся
+    в кольцевом буфере (для оверлея), а гистограммы - за всю карту (для сохранения в JSON).
+    """
+
+    def __init__(self, stages: Sequence[str], size: int = RING_SIZE):
+        """
+        :param stages: названия этапов
+        :param size: размер кольцевого буфера в кадрах
+        """
+        self.stages = list(stages)
+        self.stage_index = {stage: i for i, stage in enumerate(self.stages)}
+
+        # Последняя строка - время всего кадра
+        self.ring = np.zeros((len(self.stages) + 1, size))
+        self.size = size
+        self.position = 0
+        self.count = 0
+        self.histograms = np.zeros((len(self.stages) + 1, HISTOGRAM_BINS), dtype=np.int64)
+
+        self.frame = [0.] * len(self.stages)
+        self.last = time.perf_counter()
+
+    def start(self) -> None:
+        """
+        Начинает отсчёт заново (время до вызова никуда не записывается)
+
+        :return: None
+        """
+        self.last = time.perf_counter()
+
+    def lap(self, stage: str) -> None:
+        """
+        Записывает время с прошлого lap (или start) в этап stage текущего кадра
+
+        :param stage: название этапа
+        :return: None
+        """
+        now = time.perf_counter()
+        self.frame[self.stage_index[stage]] += (now - self.last) * 1000
+        self.last = now
+
+    def end_frame(self) -> None:
+        """
+        Заканчивает кадр: его время по этапам записывается в буфер и гистограммы
+
+        :return: None
+        """
+        times = self.frame + [sum(self.frame)]
+        self.ring[:, self.position] = times
+
+        bins = np.minimum(np.array(times) / HISTOGRAM_BIN_MS, HISTOGRAM_BINS - 1).astype(int)
+        self.histograms[np.arange(len(times)), bins] += 1
+
+        self.position = (self.position + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        self.frame = [0.] * len(self.stages)
+
+    def get_stats(self) -> Dict[str, Tuple[float, float]]:
+        """
+        :return: словарик {этап: (среднее время, p99) в мс} по последним кадрам, 'frame' - весь кадр
+        """
+        if not self.count:
+            return {stage: (0., 0.) for stage in self.stages + ['frame']}
+
+        ring = self.ring[:, :self.count]
+        means = ring.mean(axis=1)
+        p99 = np.percentile(ring, 99, axis=1)
+
+        return {stage: (float(means[i]), float(p99[i])) for i, stage in enumerate(self.stages + ['frame'])}
+
+    def export(self, path: str, info: dict) -> None:
+        """
+        Сохраняет гистограммы времени кадра и этапов за всю карту в JSON
+
+        :param path: путь файла
+        :param info: что ещё записать в файл (карта, настройки)
+        :return: None
+        """
+        report = dict(info)
+        report.update({
+            'platform': platform.platform(),
+            'python': sys.version.split()[0],
+            'pygame': pg.version.ver,
+            'frames': int(self.histograms[-1].sum()),
+            'bin_ms': HISTOGRAM_BIN_MS,
+            'histograms': {stage: self.histograms[i].tolist() for i, stage in enumerate(self.stages + ['frame'])},
+        })
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False)
@@ -0,0 +1,294 @@
+import os
+import json
+import time
+import struct
+import hashlib
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Tuple, Union, List, Dict
+
+import numpy as np
+
+from utils.archive import open_resource
+from utils.beatmap_utils import compile_beatmap, split_columns, get_map_duration
+from utils.track import TrackJudgement
+from utils.score_master import ScoreMaster
+from utils.hit_errors import HitErrors
+
+REPLAY_EXTENSION = '.pmr'
+# Меняется при изменении формата, старые повторы при этом не читаются
+REPLAY_VERSION = 1
+REPLAY_MAGIC = b'PMRP'
+# Заголовок: магия, версия, длина пути карты в байтах, дальше путь карты (utf-8) и HEADER_TAIL_FORMAT
+HEADER_FORMAT = '<4sHH'
+# sha1 файла карты (чтобы не пересчитывать повтор по изменённой карте) и время записи (unix)
+HEADER_TAIL_FORMAT = '<20sq'
+# После заголовка до конца файла идут события, каждое - int32 little-endian:
+# время карты в мс << EVENT_SHIFT | номер дорожки << 1 | состояние клавиши
+EVENT_SHIFT = 6
+EVENT_DTYPE = np.dtype('<i4')
+# Сколько повторов одной карты пересчитывается в одной задаче процесса
+RESCORE_BATCH = 64
+
+
+def get_event_time(map_time: float) -> int:
+    """
+    :param map_time: время события по времени карты в мс
+    :return: время события так, как оно записывается в повтор (целые мс). Игра оценивает события
+    по этому же времени, иначе пересчёт повтора на картах с дробными рамками очков расходится с игрой
+    """
+    return int(round(map_time))
+
+
+def get_file_hash(path: str) -> bytes:
+    """
+    :param path: путь к файлу (может вести внутрь архива .osz)
+    :return: sha1 содержимого файла
+    """
+    with open_resource(path) as f:
+        return hashlib.sha1(f.read()).digest()
+
+
+class ReplayRecorder:
+    """
+    Запись нажатий и отпусканий клавиш за игру. События пишутся в заранее выделенный буфер
+    (по одному int32 на событие), который удваивается, если его не хватило, так что запись
+    во время игры ничего не выделяет.
+    """
+
+    def __init__(self, capacity: int = 4096):
+        """
+        :param capacity: на сколько событий выделить буфер
+        """
+        self.events = np.empty(max(capacity, 1), dtype=EVENT_DTYPE)
+        self.count = 0
+
+    def record(self, track_number: int, key_state: int, map_time: float) -> None:
+        """
+        Записывает событие клавиши
+
+        :param track_number: номер дорожки
+        :param key_state: 1 если клавиша нажата, 0 если отпущена
+        :param map_time: время события по времени карты в мс
+        :return: None
+        """
+        if self.count == len(self.events):
+            self.events = np.concatenate((self.events, np.empty_like(self.events)))
+
+        event = (get_event_time(map_time) << EVENT_SHIFT) | (track_number << 1) | (1 if key_state else 0)
+        self.events[self.count] = event
+        self.count += 1
+
+    def save(self, path: str, beatmap: str) -> None:
+        """
+        Сохраняет повтор в файл
+
+        :param path: путь файла повтора
+        :param beatmap: путь к файлу карты
+        :return: None
+        """
+        beatmap_path = beatmap.encode('utf-8')
+        header = struct.pack(HEADER_FORMAT, REPLAY_MAGIC, REPLAY_VERSION, len(beatmap_path)) + beatmap_path + \
+            struct.pack(HEADER_TAIL_FORMAT, get_file_hash(beatmap), int(time.time()))
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(header)
+            f.write(self.events[:self.count].tobytes())
+
+
+def read_replay(path: str, header_only: bool = False) -> dict:
+    """
+    Читает файл повтора
+
+    :param path: путь файла повтора
+    :param header_only: читать только заголовок (без событий)
+    :return: словарик с 'beatmap', 'beatmap_hash', 'created' и (если не header_only) массивами событий
+    'times' (мс), 'tracks' и 'states' в порядке записи
+    """
+    with open(path, 'rb') as f:
+        header = f.read(struct.calcsize(HEADER_FORMAT))
+        if len(header) < struct.calcsize(HEADER_FORMAT) or not header.startswith(REPLAY_MAGIC):
+            raise ValueError(f'{path} is not a replay file')
+        _, version, path_length = struct.unpack(HEADER_FORMAT, header)
+        if version != REPLAY_VERSION:
+            raise ValueError(f'{path} has unsupported replay version {version}')
+
+        beatmap = f.read(path_length).decode('utf-8')
+        beatmap_hash, created = struct.unpack(HEADER_TAIL_FORMAT, f.read(struct.calcsize(HEADER_TAIL_FORMAT)))
+        replay = {'beatmap': beatmap, 'beatmap_hash': beatmap_hash, 'created': created}
+
+        if not header_only:
+            events = np.frombuffer(f.read(), dtype=EVENT_DTYPE)
+            replay['times'] = events >> EVENT_SHIFT
+            replay['tracks'] = (events >> 1) & ((1 << (EVENT_SHIFT - 1)) - 1)
+            replay['states'] = events & 1
+
+    return replay
+
+
+def rescore(hitobjects: np.ndarray, track_count: int, od: float, events: List[Tuple[float, int, int]],
+            hit_errors: HitErrors = None) -> ScoreMaster:
+    """
+    Оценивает события клавиш так же, как игра (см. Game.set_track_state), но без рендера
+
+    :param hitobjects: np.array с объектами карты (HITOBJECT_DTYPE), не меняется
+    :param track_count: количество дорожек
+    :param od: Overal Difficulty карты
+    :param events: события (время карты в мс, номер дорожки, состояние клавиши) в порядке записи
+    :param hit_errors: куда записывать смещения нажатий (None - не записывать)
+    :return: ScoreMaster с очками за игру
+    """
+    score_master = ScoreMaster()
+    tracks = [TrackJudgement(score_master, column, od, track_number, hit_errors)
+              for track_number, column in enumerate(split_columns(hitobjects, track_count))]
+
+    for map_time, track_number, key_state in events:
+        for track in tracks:
+            track.judge_misses(map_time)
+        if track_number < track_count:
+            tracks[track_number].set_state(key_state, map_time)
+
+    end_time = get_map_duration(hitobjects) + 3000
+    for track in tracks:
+        track.judge_misses(end_time)
+
+    return score_master
+
+
+def rescore_beatmap(beatmap: str, replays: List[str]) -> List[dict]:
+    """
+    Пересчитывает очки повторов одной карты. Выполняется в отдельном процессе (см. rescore_replays),
+    карта читается один раз на все переданные повторы.
+
+    :param beatmap: путь к файлу карты
+    :param replays: пути файлов повторов этой карты
+    :return: результат каждого повтора (см. main), в 'error' - почему повтор не пересчитан
+    """
+    try:
+        metadata, arrays = compile_beatmap(beatmap)
+        beatmap_hash = get_file_hash(beatmap)
+    except Exception as e:
+        return [{'replay': replay, 'beatmap': beatmap, 'error': f'cannot read beatmap: {e}'} for replay in replays]
+
+    hitobjects = arrays['hitobjects']
+    track_count = int(metadata['CircleSize'])
+    od = float(metadata['OverallDifficulty'])
+
+    results = []
+    for replay_file in replays:
+        result = {'replay': replay_file, 'beatmap': beatmap}
+        try:
+            replay = read_replay(replay_file)
+        except (OSError, ValueError, struct.error) as e:
+            result['error'] = str(e)
+            results.append(result)
+            continue
+
+        if replay['beatmap_hash'] != beatmap_hash:
+            result['error'] = 'beatmap has changed since the replay was recorded'
+            results.append(result)
+            continue
+
+        events = zip(replay['times'].tolist(), replay['tracks'].tolist(), replay['states'].tolist())
+        hit_errors = HitErrors(len(replay['times']))
+        score_master = rescore(hitobjects, track_count, od, list(events), hit_errors)
+        result.update({
+            'created': replay['created'],
+            'score': score_master.get_score(),
+            'accuracy': score_master.get_accuracy(),
+            'hit_counts': score_master.get_hit_counts(),
+            'max_combo': score_master.get_max_combo(),
+            'unstable_rate': hit_errors.get_unstable_rate(),
+            'mean_offset': hit_errors.get_mean(),
+        })
+        results.append(result)
+
+    return results
+
+
+def find_replays(paths: List[str]) -> List[str]:
+    """
+    :param paths: файлы повторов и папки с ними
+    :return: пути всех файлов повторов (папки просматриваются рекурсивно)
+    """
+    replays = []
+    for path in paths:
+        if os.path.isdir(path):
+            for folder, _, files in os.walk(path):
+                replays += [os.path.join(folder, file) for file in sorted(files) if file.endswith(REPLAY_EXTENSION)]
+        else:
+            replays.append(path)
+    return replays
+
+
+def rescore_replays(replays: List[str], workers: Union[int, None] = None) -> Dict[str, List[dict]]:
+    """
+    Пересчитывает очки повторов по текущим рамкам очков (get_hit_windows) в нескольких процессах
+
+    :param replays: пути файлов повторов
+    :param workers: количество процессов (None - по числу ядер)
+    :return: словарик {путь карты: результаты её повторов по убыванию очков}
+    """
+    by_beatmap = dict()
+    errors = []
+    for replay in replays:
+        try:
+            by_beatmap.setdefault(read_replay(replay, header_only=True)['beatmap'], []).append(replay)
+        except (OSError, ValueError, struct.error) as e:
+            errors.append({'replay': replay, 'beatmap': None, 'error': str(e)})
+
+    rankings = dict()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        # Повторы одной карты делятся на части, чтобы и одна карта пересчитывалась на всех ядрах
+        futures = [executor.submit(rescore_beatmap, beatmap, files[i:i + RESCORE_BATCH])
+                   for beatmap, files in by_beatmap.items() for i in range(0, len(files), RESCORE_BATCH)]
+        for future in as_completed(futures):
+            for result in future.result():
+                rankings.setdefault(result['beatmap'], []).append(result)
+
+    for results in rankings.values():
+        results.sort(key=lambda result: -result.get('score', -1))
+    if errors:
+        rankings[None] = errors
+
+    return rankings
+
+
+def main() -> None:
+    with open('./settings/game_config.json', 'r') as f:
+        game_config = json.load(f)
+
+    parser = argparse.ArgumentParser(description='Rescore recorded replays with the current hit windows '
+                                                 'and rank them per beatmap.')
+    parser.add_argument('replays', nargs='*', default=[game_config['replay_directory']],
+                        help='replay files or directories (default: %(default)s)')
+    parser.add_argument('--jobs', type=int, default=None, help='number of worker processes (default: all cores)')
+    parser.add_argument('--json', help='also write results to this file')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    replays = find_replays(args.replays)
+    rankings = rescore_replays(replays, args.jobs)
+
+    for beatmap, results in rankings.items():
+        print(beatmap if beatmap is not None else 'Unreadable replays')
+        for place, result in enumerate(results, 1):
+            if 'error' in result:
+                print(f"      {result['replay']}: {result['error']}")
+            else:
+                print(f"{place:>4}. {result['score']:>12}  {result['accuracy']:6.2f}%  {result['max_combo']:>5}x  "
+                      f"{result['hit_counts']}  UR {result['unstable_rate']:.0f} {result['mean_offset']:+.1f} ms  "
+                      f"{result['replay']}")
+
+    print(f'Rescored {len(replays)} replays in {time.perf_counter() - start:.2f} s')
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({str(beatmap): results for beatmap, results in rankings.items()}, f,
+                      ensure_ascii=False, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,23 @@
-from typing import Tuple
+from array import array
+from typing import Tuple, List
+
+# Допустимые оценки. В журнале оценок хранится индекс оценки в этом кортеже
+JUDGEMENTS = (300, 100, 50, 0, -1)
+JUDGEMENT_CODES = {judgement: code for code, judgement in enumerate(JUDGEMENTS)}
 
 
 class ScoreMaster:
     """
     Класс для удобной работы с очками, их подсчета и хранения.
+    Итоги (очки, комбо, сумма и количество каждой оценки) считаются при добавлении,
+    поэтому все методы get_ работают за O(1) и на длинных картах не замедляются.
     """
 
     def __init__(self):
-        self.score_list = []
+        # Все оценки по порядку, по байту на оценку (индекс в JUDGEMENTS)
+        self.judgements = array('b')
+        self.counts = [0] * len(JUDGEMENTS)
+        self.total = 0
         self.score = 0
         self.combo = 0
         self.max_combo = 0
@@ -19,7 +29,8 @@ class ScoreMaster:
         :param x: То, что добавляется в список. Допустимые значения - (300, 100, 50, 0, -1)
         :return: None
         """
-        if x not in (-1, 0, 50, 100, 300):
+        code = JUDGEMENT_CODES.get(x)
+        if code is None:
             raise ValueError("Trying to append invalid value")
 
         if x >= 50:
@@ -28,7 +39,17 @@ class ScoreMaster:
         else:
             self.combo = 0
         self.max_combo = max(self.combo, self.max_combo)
-        self.score_list.append(x)
+
+        self.judgements.append(code)
+        self.counts[code] += 1
+        self.total += x
+
+    def get_judgements(self) -> List[int]:
+        """
+        Возвращает все оценки по порядку
+        :return: list
+        """
+        return [JUDGEMENTS[code] for code in self.judgements]
 
     def get_combo(self) -> int:
         """
@@ -56,7 +77,7 @@ class ScoreMaster:
         Возвращает текущую точность
         :return: float
         """
-        return 100 * (sum(self.score_list) / (300 * len(self.score_list)) if self.score_list else 1.)
+        return 100 * (self.total / (300 * len(self.judgements)) if self.judgements else 1.)
 
     def get_hit_counts(self) -> Tuple[int, int, int, int]:
         """
@@ -64,21 +85,10 @@ class ScoreMaster:
 
         :return: Количество 300, 100, 50 и миссов в виде (300, 100, 50, miss)
         """
-        counts = [0, 0, 0, 0]
-
-        for hit in self.score_list:
-            if hit == 300:
-                counts[0] += 1
-            elif hit == 100:
-                counts[1] += 1
-            elif hit == 50:
-                counts[2] += 1
-            elif hit == 0:
-                counts[3] += 1
-            else:
-                raise ValueError(f"Invalid value in score list: {hit}")
+        if self.counts[JUDGEMENT_CODES[-1]]:
+            raise ValueError("Invalid value in score list: -1")
 
-        return tuple(counts)
+        return self.counts[0], self.counts[1], self.counts[2], self.counts[3]
 
     def get_rank(self) -> str:
         """
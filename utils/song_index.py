@@ -0,0 +1,126 @@
+import re
+from bisect import bisect_left
+from typing import List
+
+import numpy as np
+
+TOKEN_RE = re.compile(r'\w+')
+
+# Ключи сортировки списка песен
+SORT_KEYS = ('title', 'keys', 'duration', 'difficulty')
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Разбивает текст на слова для поиска
+
+    :param text: текст
+    :return: список слов в нижнем регистре
+    """
+    return TOKEN_RE.findall(text.lower())
+
+
+class SongIndex:
+    """
+    Поисковый индекс по сложностям библиотеки карт.
+
+    Каждая сложность индексируется по словам названия, исполнителя, названия сложности и количеству клавиш
+    (слово вида '4k'). Слова хранятся в отсортированном списке, поэтому все слова с заданным префиксом
+    находятся бинарным поиском. Для каждого ключа сортировки заранее хранится порядок сложностей,
+    и результаты поиска просто фильтруют этот порядок.
+    """
+
+    def __init__(self):
+        self.sets = []
+        self.diff_sets = []
+        self.sort_values = {key: [] for key in SORT_KEYS}
+        self.postings = dict()
+
+        # Заполняются в build
+        self.tokens = []
+        self.token_postings = []
+        self.diff_sets_array = np.zeros(0, dtype=np.int32)
+        self.orders = dict()
+        self.dirty = False
+
+    def add(self, beatmap_set: dict) -> int:
+        """
+        Добавляет карту в индекс
+
+        :param beatmap_set: данные карты (см. get_beatmap_set)
+        :return: номер карты в индексе (по порядку добавления)
+        """
+        set_id = len(self.sets)
+        self.sets.append(beatmap_set)
+
+        set_tokens = tokenize(beatmap_set['title']) + tokenize(beatmap_set['artist'])
+
+        for diff in beatmap_set['diffs']:
+            diff_id = len(self.diff_sets)
+            self.diff_sets.append(set_id)
+
+            for token in set(set_tokens + tokenize(diff['version']) + [f"{diff['circle_size']}k"]):
+                self.postings.setdefault(token, []).append(diff_id)
+
+            self.sort_values['title'].append(beatmap_set['title'].lower())
+            self.sort_values['keys'].append(diff['circle_size'])
+            self.sort_values['duration'].append(diff['duration'])
+            self.sort_values['difficulty'].append(diff['stars'])
+
+        self.dirty = True
+        return set_id
+
+    def build(self) -> None:
+        """
+        Строит отсортированный список слов и порядки сортировки. Вызывается из search после добавления карт.
+
+        :return: None
+        """
+        self.tokens = sorted(self.postings)
+        self.token_postings = [np.array(self.postings[token], dtype=np.int32) for token in self.tokens]
+        self.diff_sets_array = np.array(self.diff_sets, dtype=np.int32)
+
+        diff_ids = range(len(self.diff_sets))
+        for key in SORT_KEYS:
+            values = self.sort_values[key]
+            self.orders[key] = np.array(sorted(diff_ids, key=values.__getitem__), dtype=np.int32)
+
+        self.dirty = False
+
+    def match_prefix(self, prefix: str) -> np.ndarray:
+        """
+        Находит сложности, у которых есть слово с заданным префиксом
+
+        :param prefix: префикс слова
+        :return: np.array номеров сложностей
+        """
+        start = bisect_left(self.tokens, prefix)
+        end = bisect_left(self.tokens, prefix + '\uffff', lo=start)
+
+        if start == end:
+            return np.zeros(0, dtype=np.int32)
+
+        return np.concatenate(self.token_postings[start:end])
+
+    def search(self, query: str, sort: str = 'title') -> List[int]:
+        """
+        Ищет карты, в сложностях которых есть все слова запроса (как префиксы)
+
+        :param query: строка запроса, пустая строка - все карты
+        :param sort: ключ сортировки (см. SORT_KEYS)
+        :return: номера подходящих карт в порядке сортировки по их первой подходящей сложности
+        """
+        if self.dirty:
+            self.build()
+
+        mask = np.ones(len(self.diff_sets), dtype=bool)
+        for term in tokenize(query):
+            term_mask = np.zeros_like(mask)
+            term_mask[self.match_prefix(term)] = True
+            mask &= term_mask
+
+        order = self.orders.get(sort, np.zeros(0, dtype=np.int32))
+        set_ids = self.diff_sets_array[order[mask[order]]]
+
+        _, first = np.unique(set_ids, return_index=True)
+        return set_ids[np.sort(first)].tolist()
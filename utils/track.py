@@ -5,6 +5,8 @@ import pygame as pg
 import pygame.draw as draw
 
 from utils.score_master import ScoreMaster
+from utils.hit_errors import HitErrors
+from utils.beatmap_utils import NOTE, HOLD
 
 
 def get_hit_windows(od: float) -> Tuple[float, float, float]:
@@ -19,38 +21,169 @@ def get_hit_windows(od: float) -> Tuple[float, float, float]:
     return window_300, windows_100, window_50
 
 
-class Track:
+class TrackJudgement:
+    """
+    Оценка нажатий одной дорожки без рендера. Используется дорожкой игры (Track)
+    и пересчётом очков по повторам (см. utils.replay).
+    """
+    def __init__(self, score_list: Union[List, ScoreMaster], hitobjects: np.ndarray, od: float = 5.,
+                 track_number: int = 0, hit_errors: HitErrors = None):
+        """
+        :param score_list: Список хранящий очки за нажатия
+        :param hitobjects: np.array объектов этой дорожки (HITOBJECT_DTYPE, см. split_columns)
+        :param od: Overal Difficulty карты
+        :param track_number: Номер дорожки
+        :param hit_errors: Куда записывать смещения оценённых нажатий (None - не записывать)
+        """
+        self.track_number = track_number
+        self.score_list = score_list
+        self.hit_errors = hit_errors
+
+        # Поля - это представления, поэтому запись в scores меняет hitobjects
+        self.hitobjects = hitobjects
+        self.times = hitobjects['time']
+        self.end_times = hitobjects['endTime']
+        self.types = hitobjects['type']
+        self.scores = hitobjects['score']
+
+        # Первый ещё не оцененный объект и зажатый холд (см. judge_misses)
+        self.cursor = 0
+        self.held = None
+
+        self.window_300, self.window_100, self.window_50 = get_hit_windows(od)
+
+        self.state = 0
+
+    def get_score(self, time_diff: int) -> int:
+        """
+        Calculates the score for a given press
+        :param time_diff: current_time - hit_time
+        :return: Score earned for that hit
+        """
+        if time_diff > self.window_50:
+            return 0
+        elif time_diff < -self.window_50:
+            return -1
+        elif self.window_50 >= abs(time_diff) > self.window_100:
+            return 50
+        elif self.window_100 >= abs(time_diff) > self.window_300:
+            return 100
+        elif self.window_300 >= abs(time_diff):
+            return 300
+
+    def judge_misses(self, current_time: float) -> None:
+        """
+        Отмечает пропущенными объекты (для холда - начало), окно нажатия которых закончилось к current_time.
+        Все объекты до self.cursor уже оценены (или это зажатый холд self.held).
+
+        :param current_time: Время карты в мс
+        :return: None
+        """
+        while self.cursor < len(self.times) and current_time - self.times[self.cursor] > self.window_50:
+            self.scores[self.cursor] = 0
+            self.score_list.append(0)
+            self.cursor += 1
+
+    def press(self, press_time: float) -> None:
+        """
+        Оценивает нажатие клавиши дорожки. Нажатие относится к объекту под курсором.
+
+        :param press_time: Время нажатия по времени карты в мс
+        :return: None
+        """
+        self.judge_misses(press_time)
+
+        if self.cursor < len(self.times):
+            time_diff = press_time - self.times[self.cursor]
+            score = self.get_score(time_diff)
+            if score >= 50:
+                if self.hit_errors is not None:
+                    self.hit_errors.add(self.track_number, press_time, time_diff)
+                if self.types[self.cursor] == NOTE:
+                    self.scores[self.cursor] = score
+                    self.score_list.append(score)
+                else:
+                    self.scores[self.cursor] = 1  # 1 means it is being held
+                    self.held = self.cursor
+                self.cursor += 1
+
+    def release(self, release_time: float) -> None:
+        """
+        Оценивает отпускание клавиши дорожки. Отпускание относится к зажатому холду.
+
+        :param release_time: Время отпускания по времени карты в мс
+        :return: None
+        """
+        self.judge_misses(release_time)
+
+        if self.held is not None:
+            time_diff = release_time - self.end_times[self.held]
+            end_score = self.get_score(time_diff)
+            if end_score == -1:
+                end_score = 0
+            elif end_score >= 50 and self.hit_errors is not None:
+                self.hit_errors.add(self.track_number, release_time, time_diff)
+            self.scores[self.held] = end_score
+            self.score_list.append(end_score)
+            self.held = None
+
+    def set_state(self, state: Union[int, bool], map_time: float) -> None:
+        """
+        Меняет состояние клавиши дорожки и сразу оценивает нажатие или отпускание в момент события,
+        а не в момент следующего кадра
+
+        :param state: 1 если клавиша нажата, 0 если отпущена
+        :param map_time: Время события по времени карты в мс
+        :return: None
+        """
+        if state and not self.state:
+            self.press(map_time)
+        elif not state and self.state:
+            self.release(map_time)
+        self.state = int(state)
+
+
+class Track(TrackJudgement):
     """
     Класс дорожки. Используется для удобной работы с дорожками.
     """
-    def __init__(self, track_number: int, track_key: int, score_list: Union[List, ScoreMaster],
+    def __init__(self, track_number: int, track_key: int, score_list: Union[List, ScoreMaster], hitobjects: np.ndarray,
                  od: float = 5., width: int = 100, height: int = 800, note_height: int = 30, hold_width: int = 80,
                  fall_time: int = 1000,
                  bg_color: Union[int, Tuple[int, int, int]] = 0xffffff,
                  note_color: Tuple[Union[int, Tuple[int, int, int]], Union[int, Tuple[int, int, int]]]
                  = (0xff0000, 0x000000), hold_color: Union[int, Tuple[int, int, int]] = 0x000000,
                  key_color: Tuple[Union[int, Tuple[int, int, int]], Union[int, Tuple[int, int, int]]]
-                 = (0x800406, 0xe10509), hit_distance: int = 100):
+                 = (0x800406, 0xe10509), hit_distance: int = 100, hit_errors: HitErrors = None):
         """
         :param track_number: Номер дорожки
         :param track_key: Клавиша дорожки
         :param score_list: Список хранящий очки за нажатия
+        :param hitobjects: np.array объектов этой дорожки (HITOBJECT_DTYPE, см. split_columns)
         :param width: Ширина дорожки
         :param height: Высота дорожки
         :param note_height: Высота нот
         :param hold_width: Ширина тонкой части холда
         :param fall_time: Время в мс за которое нота проходит от начала дорожки до точки нажатия
+                          (при скорости прокрутки 1, см. get_scroll_table)
         :param bg_color: Цвет дорожки
         :param note_color: Union(Color, Color). Цвета нот
         :param hold_color: Union(Color, Color). Цвета тонкой части холда
         :param key_color: Union(Color, Color). Цвета клавишы
         :param hit_distance: Высота точки нажатия измеряя от нижней части дорожки
+        :param hit_errors: Куда записывать смещения оценённых нажатий (см. HitErrors)
         """
-        self.track_number = track_number
+        super().__init__(score_list, hitobjects, od, track_number, hit_errors)
+
         self.track_key = track_key
-        self.score_list = score_list
 
-        self.window_300, self.window_100, self.window_50 = get_hit_windows(od)
+        self.positions = hitobjects['position']
+        self.end_positions = hitobjects['endPosition']
+        # Отсортирован, даже если объекты дорожки перекрываются (см. get_render_window)
+        self.max_end_times = np.maximum.accumulate(self.end_times) if len(hitobjects) else self.end_times
+
+        self.render_start = 0
+        self.render_end = 0
 
         self.width = width
         self.height = height
@@ -67,130 +200,92 @@ class Track:
         self.hit_distance = hit_distance
         self.fall_time = fall_time
 
-        self.state = 0
-        self.last_state = 0
+        self.surface = pg.Surface((width, height)).convert()
 
-        self.surface = pg.Surface((width, height))
+        # Заготовки нот и тел холдов для обоих состояний (не оценен, оценен), рисуются один раз
+        self.note_sprites = []
+        self.hold_sprites = []
+        for i in range(2):
+            note_sprite = pg.Surface((width, note_height)).convert()
+            note_sprite.fill(note_color[i])
+            self.note_sprites.append(note_sprite)
+
+            hold_sprite = pg.Surface((hold_width, height)).convert()
+            hold_sprite.fill(hold_color[i])
+            self.hold_sprites.append(hold_sprite)
 
         key_name = pg.key.name(self.track_key)
         key_font = pg.font.Font('./assets/PTMono-Regular.ttf', hit_distance // 10)
         self.key_name_surface = key_font.render(key_name, True, (128, 128, 128))
 
-    def get_score(self, time_diff: int) -> int:
+        # Неподвижные части дорожки рисуются один раз: фон с линией над клавишей (без области клавиши,
+        # её всё равно закрывает клавиша) и клавиша в обоих состояниях (отпущена, нажата) вместе с подписью
+        self.background = pg.Surface((width, height - hit_distance)).convert()
+        self.background.fill(bg_color)
+        draw.line(self.background, 0xaaaaaa, (0, height - hit_distance - note_height),
+                  (width, height - hit_distance - note_height), 3)
+
+        self.key_sprites = []
+        w, h = self.key_name_surface.get_size()
+        for i in range(2):
+            key_sprite = pg.Surface((width, hit_distance)).convert()
+            key_sprite.fill(key_color[i])
+            key_sprite.blit(self.key_name_surface, ((width - w) // 2, (hit_distance - h) // 2))
+            self.key_sprites.append(key_sprite)
+
+    def get_render_window(self, current_time: float, current_position: float) -> Tuple[int, int]:
         """
-        Calculates the score for a given press
-        :param time_diff: current_time - hit_time
-        :return: Score earned for that hit
+        Возвращает, какие объекты дорожки видны на экране (или недавно закончились), чтобы рендерить только их.
+        Оба края ищутся бинарным поиском: начало - по накопленному максимуму endTime (длинный холд
+        не держит начало окна на месте), конец - по положению на ленте прокрутки.
+
+        :param current_time: Текущее время карты в мс
+        :param current_position: Текущее положение ленты прокрутки (см. get_scroll_position)
+        :return: render_start, render_end - индексы в self.hitobjects
         """
-        if time_diff > self.window_50:
-            return 0
-        elif time_diff < -self.window_50:
-            return -1
-        elif self.window_50 >= abs(time_diff) > self.window_100:
-            return 50
-        elif self.window_100 >= abs(time_diff) > self.window_300:
-            return 100
-        elif self.window_300 >= abs(time_diff):
-            return 300
+        self.render_start = int(np.searchsorted(self.max_end_times, current_time - 1000, side='left'))
+        self.render_end = int(np.searchsorted(self.positions, current_position + 1000 + self.fall_time,
+                                              side='right'))
+        return self.render_start, max(self.render_start, self.render_end)
 
-    def update(self, current_time: int, hitobject_list: Union[np.array, List]) -> None:
+    def update(self, current_time: float, current_position: float) -> None:
         """
-        Обновляет дорожку
+        Обновляет дорожку (рисует объекты на момент current_time, оценку не меняет)
 
         :param current_time: Текущее время карты в мс
-        :param hitobject_list: Список объектов которые будут рендерится
+        :param current_position: Текущее положение ленты прокрутки (см. get_scroll_position)
         :return: None
         """
-        self.surface.fill(self.bg_color)
-
-        # Линия сверху клавиш
-        draw.line(self.surface, 0xaaaaaa, (0, self.height - self.hit_distance - self.note_height),
-                  (self.width, self.height - self.hit_distance - self.note_height), 3)
-
-        # press 1 если зажатие, 0 если ничего, -1 если отпускание
-        if self.last_state != self.state:
-            press = 1 if self.state == 1 else -1
-        else:
-            press = 0
-
-        for hitobject in hitobject_list:
-            if hitobject['x'] != self.track_number:
-                continue
-
-            time_diff = current_time - hitobject['time']
-            if hitobject['type'] == 'note':
-                score = self.get_score(time_diff)
-                if score == 0 and hitobject['score'] == -1:
-                    hitobject['score'] = 0
-                    self.score_list.append(0)
-                if press == 1:
-                    if hitobject['score'] == -1:
-                        if score == -1:
-                            press = 0
-                        elif score >= 50:
-                            hitobject['score'] = score
-                            self.score_list.append(score)
-                            press = 0
-            else:
-                start_score = self.get_score(time_diff)
-                if start_score == 0 and hitobject['score'] == -1:
-                    hitobject['score'] = 0
-                    self.score_list.append(0)
-                if press == 1:
-                    if hitobject['score'] == -1:
-                        if start_score == -1:
-                            press = 0
-                        elif start_score >= 50:
-                            hitobject['score'] = 1  # 1 means it is being held
-                            press = 0
-                if press == -1:
-                    end_score = self.get_score(current_time - hitobject['endTime'])
-                    if hitobject['score'] == 1:
-                        if end_score != -1:
-                            hitobject['score'] = end_score
-                            self.score_list.append(end_score)
-                            press = 0
-                        elif end_score == -1:
-                            hitobject['score'] = 0
-                            self.score_list.append(0)
-                            press = 0
-
-            if hitobject['type'] == 'note':
-                y = (current_time - hitobject['time'] + self.fall_time) * (self.height - self.hit_distance) \
-                    / self.fall_time - self.note_height
-
-                note_color = self.note_color[hitobject['score'] != -1]
-
-                draw.rect(self.surface, note_color, (0, y, self.width, self.note_height))
-
-            elif hitobject['type'] == 'hold':
-                y_start = (current_time - hitobject['time'] + self.fall_time) * (self.height - self.hit_distance) \
-                    / self.fall_time - self.note_height
-
-                y_end = (current_time - hitobject['endTime'] + self.fall_time) * (self.height - self.hit_distance) \
-                    / self.fall_time - self.note_height
-
-                note_color = self.note_color[hitobject['score'] != -1]
-                hold_color = self.hold_color[hitobject['score'] != -1]
-                draw.rect(self.surface, hold_color,
-                          (self.hold_x, y_end, self.hold_width, y_start - y_end + self.note_height))
-
-                draw.rect(self.surface, note_color, (0, y_start, self.width, self.note_height))
-                draw.rect(self.surface, note_color, (0, y_end, self.width, self.note_height))
-
-        # Клавиша
-        draw.rect(self.surface, self.key_color[self.state],
-                  (0, self.height - self.hit_distance, self.width, self.hit_distance))
-
-        w, h = self.key_name_surface.get_size()
-        x = (self.width - w) // 2
-        y = self.height - self.hit_distance + (self.hit_distance - h) // 2
-        self.surface.blit(self.key_name_surface, (x, y))
-
-        self.last_state = self.state
-
-    def set_state(self, state: Union[int, bool]) -> None:
-        self.state = state
+        # Фон с линией сверху клавиш
+        self.surface.blit(self.background, (0, 0))
+
+        # Нажатия и отпускания оценены в set_state, пропуски - до рисования (см. Game.judge)
+        start, end = self.get_render_window(current_time, current_position)
+        scores = self.scores[start:end]
+        types = self.types[start:end]
+
+        # Положения всех видимых объектов дорожки считаются сразу
+        scale = (self.height - self.hit_distance) / self.fall_time
+        y_starts = (current_position - self.positions[start:end] + self.fall_time) * scale - self.note_height
+        y_ends = (current_position - self.end_positions[start:end] + self.fall_time) * scale - self.note_height
+        judged = (scores != -1).astype(np.int8)
+        holds = types == HOLD
+
+        # Тела холдов обрезаются по дорожке, чтобы брать из заготовки только видимую часть
+        hold_tops = np.maximum(y_ends[holds], 0)
+        hold_heights = np.minimum(y_starts[holds] + self.note_height, self.height) - hold_tops
+
+        # Сначала тела холдов, потом концы холдов и головы нот, всё за один вызов blits
+        sprites = [(self.hold_sprites[is_judged], (self.hold_x, top), (0, 0, self.hold_width, height))
+                   for is_judged, top, height in zip(judged[holds].tolist(), hold_tops.tolist(),
+                                                     hold_heights.tolist()) if height > 0]
+        sprites += [(self.note_sprites[is_judged], (0, y))
+                    for is_judged, y in zip(judged[holds].tolist(), y_ends[holds].tolist())]
+        sprites += [(self.note_sprites[is_judged], (0, y)) for is_judged, y in zip(judged.tolist(), y_starts.tolist())]
+        self.surface.blits(sprites, doreturn=False)
+
+        # Клавиша (поверх нот, которые под неё заходят)
+        self.surface.blit(self.key_sprites[self.state], (0, self.height - self.hit_distance))
 
     def get_surface(self) -> pg.Surface:
         """
@@ -199,7 +294,7 @@ class Track:
         """
         return self.surface
 
-    def render(self, screen: pg.Surface, x: int, y: int) -> None:
+    def render(self, screen: pg.Surface, x: int, y: int) -> pg.Rect:
         """
         Рендерит дорожку на screen в точке (x, y)
 
@@ -207,6 +302,6 @@ class Track:
         :param x: координата x на screen
         :param y: координата y на screen
 
-        :return: None
+        :return: Изменённая область screen
         """
-        screen.blit(self.surface, (x, y))
+        return screen.blit(self.surface, (x, y))
@@ -1,11 +1,17 @@
 from typing import Tuple
 
+import numpy as np
 import pygame
 import audioplayer
 import os
 
+from utils.archive import open_resource, get_local_path
+
 pygame.font.init()
 
+# width of one bar of hit error histograms on the statistics screen, ms
+HISTOGRAM_BIN_MS = 5
+
 
 def stats(game) -> pygame.Surface:
     """
@@ -61,6 +67,61 @@ def stats(game) -> pygame.Surface:
         rect = surf.get_rect(topleft=(k_w * 90, k_a * (170 + i * 75)))
         surface.blit(surf, rect)
 
+    # drawing hit error histograms between hit counts and rank image
+    histograms_x = int(520 * k_w)
+    histograms = hit_error_histograms(game, (rank_rect.left - int(20 * k_w) - histograms_x, int(290 * k_a)),
+                                      font_name)
+    surface.blit(histograms, (histograms_x, int(175 * k_a)))
+
+    return surface
+
+
+def hit_error_histograms(game, size: Tuple[int, int], font_name: str) -> pygame.Surface:
+    """
+    Returns the surface with unstable rate, mean offset and histogram of hit offsets for every column
+
+    :param game: finished Game
+    :param size: size of the surface
+    :param font_name: path to the font
+    :return: pygame.Surface with histograms
+    """
+    width, height = size
+    surface = pygame.Surface(size, pygame.SRCALPHA, 32)
+    surface.fill((0, 0, 0, 120))
+
+    hit_errors = game.hit_errors
+    max_offset = game.hit_windows[2]
+    edges, counts = hit_errors.get_histograms(game.track_count, HISTOGRAM_BIN_MS, max_offset)
+    column_means = hit_errors.get_column_means(game.track_count)
+
+    font = pygame.font.Font(font_name, max(height // 16, 8))
+    title = font.render(f'UR {hit_errors.get_unstable_rate():.2f}   mean {hit_errors.get_mean():+.2f} ms',
+                        True, (255, 255, 255))
+    surface.blit(title, (5, 3))
+
+    label_width = font.size('0 +000.0')[0] + 10
+    plot_x, plot_width = label_width, width - label_width - 5
+    top = title.get_height() + 8
+    row_height = (height - top) / max(game.track_count, 1)
+    bin_width = plot_width / counts.shape[1]
+
+    # zero offset line
+    zero_x = plot_x + plot_width * (0 - edges[0]) / (edges[-1] - edges[0])
+    pygame.draw.line(surface, (255, 230, 0), (zero_x, top), (zero_x, height - 1))
+
+    # every row is normalized by its own peak, so columns with few notes are readable too
+    peaks = np.maximum(counts.max(axis=1, keepdims=True), 1)
+    bar_heights = counts / peaks * (row_height - 4)
+    for column in range(game.track_count):
+        y = top + row_height * (column + 1) - 2
+        label = font.render(f'{column + 1} {column_means[column]:+.1f}', True, (255, 255, 255))
+        surface.blit(label, (5, y - row_height / 2 - label.get_height() / 2))
+
+        for i in np.flatnonzero(counts[column]).tolist():
+            bar_height = bar_heights[column, i]
+            pygame.draw.rect(surface, (230, 230, 255),
+                             (plot_x + i * bin_width, y - bar_height, max(bin_width - 1, 1), bar_height))
+
     return surface
 
 
@@ -119,7 +180,9 @@ class TextBox:
             self.position = [self.position[0] - self.size[0] / 2, self.position[1] - self.size[1] / 2]
         # get background surface
         if self.bg_image:
-            rect_surface = pygame.image.load(self.bg_image).convert_alpha()
+            # image can be inside of .osz archive
+            with open_resource(self.bg_image) as f:
+                rect_surface = pygame.image.load(f, os.path.basename(self.bg_image)).convert_alpha()
             self.rect_surface = smartscale(rect_surface, self.size)
         else:
             self.rect_surface = None
@@ -428,20 +491,70 @@ class DropDownList:
         self.objects = objects
         self.constants = constants
         self.drop_down_lists = []
+        # drop downs which are shown now (all or search results), in order of showing
+        self.visible = []
         self.system = system
         self.screen = self.system.screen
         self.player = player
         # count max size of objects:
         self.max_size = size
+        self.size = (self.max_size[0] + self.max_size[1], self.max_size[1] * 9)
         # add objects in working form:
-        for obj in self.objects:
-            drop_down = DropDown((self.position[0], self.position[1] + self.objects.index(obj) * self.max_size[1]),
+        self.objects = []
+        self.add(objects)
+
+    def add(self, objects):
+        """
+        add songs to the end of list
+        :param objects: [[{'text':'', 'type':main/not_main, 'func':func, 'bg_image':bg_image},...],...,]
+        :return: None
+        """
+        for obj in objects:
+            drop_down = DropDown((self.position[0], self.get_next_y()),
                                  self.image, self.font, self.font_color, obj, self.constants, self.system,
                                  (self.position[0] * self.constants['drop_down']['place_image'], self.position[1]),
                                  main_size=self.max_size)
+            self.objects.append(obj)
             self.drop_down_lists.append(drop_down)
+            self.visible.append(drop_down)
+
+    def get_next_y(self):
+        """
+        next block goes under the last visible one, moved down if the last one is opened
+        :return: y coordinate of next block
+        """
+        if not self.visible:
+            return self.position[1]
+
+        last = self.visible[-1]
+        y = last.position[1] + self.max_size[1]
+        if last.opened:
+            y += len(last.additional_objects) * last.main.size[1]
+        return y
+
+    def show(self, indices):
+        """
+        show only some of songs (for example search results)
+        opened song stays opened and on the same place in the list if it is still shown,
+        so songs found by library scan do not close it
+        :param indices: indices of songs (in order of adding) to show, in order of showing
+        :return: None
+        """
+        indices = list(indices)
+        for place, obj in enumerate(self.visible):
+            if obj.opened:
+                index = self.drop_down_lists.index(obj)
+                if index in indices:
+                    indices.remove(index)
+                    indices.insert(min(place, len(indices)), index)
+                else:
+                    obj.lock()
 
-        self.size = (self.drop_down_lists[0].size[0], self.max_size[1] * 9)
+        self.visible = []
+        for i in indices:
+            obj = self.drop_down_lists[i]
+            obj.position = (self.position[0], self.get_next_y())
+            self.visible.append(obj)
 
     def get_surface(self):
         """
@@ -449,7 +562,10 @@ class DropDownList:
         :return: surface with pictures of objects
         """
         surface = pygame.Surface(self.size, pygame.SRCALPHA, 32)
-        for obj in self.drop_down_lists:
+        for obj in self.visible:
+            if obj.position[1] - self.position[1] >= self.size[1]:
+                # the rest of list is out of surface
+                break
             surf = obj.get_surface()
             surface.blit(surf, (obj.position[0] - self.position[0], obj.position[1] - self.position[1]))
         return surface
@@ -461,40 +577,39 @@ class DropDownList:
         :return: None
         """
         if event.type == pygame.MOUSEBUTTONDOWN:
-            for obj in self.drop_down_lists:
+            for obj in self.visible:
                 status = obj.opened
 
                 obj.click(event)
 
                 # if close some drop down:
                 if status and not obj.opened:
-                    for elem in self.drop_down_lists[self.drop_down_lists.index(obj) + 1:]:
+                    for elem in self.visible[self.visible.index(obj) + 1:]:
                         elem.position = (
                             elem.position[0], elem.position[1] - len(obj.additional_objects) * obj.main.size[1])
 
                 # if open some drop down:
                 if not status and obj.opened:
                     # close others opened drop_down lists and move smth if it needed:
-                    for elem in self.drop_down_lists:
+                    for elem in self.visible:
                         if elem != obj:
                             if elem.opened:
                                 elem.lock()
                                 elem.opened = False
-                                for element in self.drop_down_lists[self.drop_down_lists.index(elem) + 1:]:
+                                for element in self.visible[self.visible.index(elem) + 1:]:
                                     element.position = (element.position[0],
                                                         element.position[1] - len(elem.additional_objects) *
                                                         elem.main.size[1])
                     # move drop_downs if smth opened:
-                    for elem in self.drop_down_lists[self.drop_down_lists.index(obj) + 1:]:
+                    for elem in self.visible[self.visible.index(obj) + 1:]:
                         elem.position = (
                             elem.position[0], elem.position[1] + len(obj.additional_objects) * obj.main.size[1])
-                    # play music
-                    for elem in self.objects:
-                        if elem == obj.objects:
-                            self.player.close()
-                            sound = elem[self.drop_down_lists.index(obj)]['music']
-                            self.player = audioplayer.AudioPlayer(sound)
-                            self.player.play()
+                    # play music (extracted from .osz archive if needed)
+                    self.player.close()
+                    sound = get_local_path(obj.objects[0]['music'],
+                                           os.path.join(self.system.Cache_directory, 'audio'))
+                    self.player = audioplayer.AudioPlayer(sound)
+                    self.player.play()
 
     def mute(self):
         if self.system.is_in_game: